@@ -1,20 +1,24 @@
 #!/usr/bin/env python3
 
+import asyncio
+import os
+import random
 import shlex
 import signal
-import subprocess
+import sys
 from argparse import ArgumentParser
+from collections import deque
+from heapq import heappop, heappush
 from pathlib import Path
-from time import sleep
+from threading import Thread
+from time import monotonic
+from typing import BinaryIO, Iterable, Iterator, List, Optional
 
 from colorama import Fore
 
-
-def on_signal(*args, **kwargs):
-    raise TimeoutError()
-
-
-signal.signal(signal.SIGALRM, on_signal)
+ARG_POINTER = 8
+KILL_DELAY = 5
+WAITING = object()
 
 
 def my_filter(iterable):
@@ -26,36 +30,483 @@ def my_filter(iterable):
     )
 
 
-def transition(prefix: str, label: str, interactive: bool, timeout: int):
+class DoneJournal:
+    """
+    set of processed items backed by an append-only file, each item is
+    written as soon as it is done and synced by batches
+    """
+
+    SYNC_COUNT = 100
+    SYNC_DELAY = 1
+
+    def __init__(self, file: Optional[Path]):
+        self.file, self.fp = file, None
+        # dict keeps the insertion order for the compaction
+        self.items, self.lines = {}, 0
+        self.unsynced, self.synced_at = 0, monotonic()
+        if file is not None:
+            compact = False
+            if file.is_file():
+                with file.open() as fp:
+                    for line in fp:
+                        self.lines += 1
+                        compact |= not line.endswith("\n")
+                        for item in my_filter([line]):
+                            self.items[item] = None
+            if compact or self.lines > len(self.items):
+                self.compact()
+            self.fp = file.open("a")
+
+    def __contains__(self, item: str):
+        return item in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item: str):
+        if item in self.items:
+            return
+        self.items[item] = None
+        if self.fp is not None:
+            self.fp.write(f"{item}\n")
+            self.fp.flush()
+            self.lines += 1
+            self.unsynced += 1
+            if (
+                self.unsynced >= self.SYNC_COUNT
+                or monotonic() - self.synced_at >= self.SYNC_DELAY
+            ):
+                self.sync()
+
+    def sync(self):
+        if self.fp is not None and self.unsynced:
+            os.fsync(self.fp.fileno())
+        self.unsynced, self.synced_at = 0, monotonic()
+
+    def compact(self):
+        """
+        rewrite the journal without duplicates, comments or blank lines
+        """
+        tmp = self.file.with_name(f".{self.file.name}.tmp")
+        with tmp.open("w") as fp:
+            fp.writelines(f"{item}\n" for item in self.items)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self.file)
+        self.lines = len(self.items)
+
+    def close(self):
+        if self.fp is not None:
+            self.sync()
+            self.fp.close()
+            self.fp = None
+
+
+async def prompt(message: str, timeout: Optional[float] = None):
+    """
+    wait for ENTER on stdin, or for the timeout, without blocking the loop
+    """
+    print(message, end="", flush=True)
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    fd = sys.stdin.fileno()
+    loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+    try:
+        await asyncio.wait_for(ready, timeout)
+        sys.stdin.readline()
+    except asyncio.TimeoutError:
+        print("")
+    finally:
+        loop.remove_reader(fd)
+
+
+async def transition(prefix: str, label: str, interactive: bool, timeout: int):
     if timeout and timeout > 0:
-        signal.alarm(timeout)
-        try:
-            input(
-                f"{prefix} Press ENTER or wait {timeout} seconds to execute: {label} "
-            )
-        except TimeoutError:
-            print("")
-        finally:
-            signal.alarm(0)
+        await prompt(
+            f"{prefix} Press ENTER or wait {timeout} seconds to execute: {label} ",
+            timeout,
+        )
     else:
         if interactive:
-            input(f"{prefix} Press ENTER to execute: {label} ")
+            await prompt(f"{prefix} Press ENTER to execute: {label} ")
         else:
             print(f"{prefix} Execute:  {label}")
 
 
-def execute(
-    command: list, label: str, retry: int, retry_delay: int = 1, verbose: bool = False
+class TokenBucket:
+    """
+    allow rate commands per second on average, and bursts of burst commands
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate, self.burst = rate, max(burst, 1)
+        self.tokens, self.updated = float(self.burst), monotonic()
+
+    async def acquire(self):
+        while True:
+            now = monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def backoff(attempt: int, delay: float, max_delay: float) -> float:
+    """
+    exponential backoff with full jitter
+    """
+    return random.uniform(0, min(max_delay, delay * 2**attempt))
+
+
+async def pump(
+    stream: asyncio.StreamReader,
+    output: BinaryIO,
+    log_file: Optional[BinaryIO],
+    buffer: Optional[List[bytes]],
+):
+    """
+    copy the output of a command to its log file and to the buffer, or to
+    the terminal when not buffered
+    """
+    while True:
+        chunk = await stream.read(1 << 16)
+        if not chunk:
+            return
+        if log_file is not None:
+            log_file.write(chunk)
+        if buffer is not None:
+            buffer.append(chunk)
+        else:
+            output.write(chunk)
+            output.flush()
+
+
+async def execute(
+    command: list,
+    label: str,
+    capture: bool = False,
+    timeout: Optional[float] = None,
+    log_path: Optional[Path] = None,
 ):
-    process = subprocess.run(command)
-    if process.returncode == 0:
-        print(f"{Fore.GREEN}OK{Fore.RESET} {label}")
+    """
+    run the command, killing it after timeout seconds, returns if the command
+    succeeded and, when capturing, everything to print
+    """
+    log, ok = [], False
+    buffers = ([], []) if capture else (None, None)
+    log_file = log_path.open("ab") if log_path is not None else None
+    piped = capture or log_file is not None
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdout=asyncio.subprocess.PIPE if piped else None,
+            stderr=asyncio.subprocess.PIPE if piped else None,
+            # with a timeout, own process group to signal everything the
+            # command spawns, otherwise stay in the terminal's foreground
+            start_new_session=timeout is not None,
+        )
+        pumps = (
+            [
+                pump(process.stdout, sys.stdout.buffer, log_file, buffers[0]),
+                pump(process.stderr, sys.stderr.buffer, log_file, buffers[1]),
+            ]
+            if piped
+            else []
+        )
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(process.wait(), *pumps), timeout=timeout
+            )
+            ok = process.returncode == 0
+        except asyncio.TimeoutError:
+            log.append((sys.stderr, f"{Fore.RED}TIMEOUT{Fore.RESET} {label}\n"))
+            await terminate(process, group=True)
+        except asyncio.CancelledError:
+            await terminate(process, group=timeout is not None)
+            raise
+    except OSError as e:
+        # for example E2BIG when the arguments are too long
+        log.append((sys.stderr, f"{Fore.RED}{e}{Fore.RESET}\n"))
+    finally:
+        if log_file is not None:
+            log_file.close()
+    if capture:
+        log[:0] = [
+            (sys.stdout, b"".join(buffers[0]).decode(errors="replace")),
+            (sys.stderr, b"".join(buffers[1]).decode(errors="replace")),
+        ]
+    if ok:
+        log.append((sys.stdout, f"{Fore.GREEN}OK{Fore.RESET} {label}\n"))
+    else:
+        log.append((sys.stdout, f"{Fore.RED}ERROR{Fore.RESET} {label}\n"))
+    if not capture:
+        print_log(log)
+        log = []
+    return ok, log
+
+
+def signal_group(
+    process: asyncio.subprocess.Process, signum: int, group: bool = True
+) -> bool:
+    """
+    send a signal to the process group of a command, or only to the command
+    if it has no group of its own, returns False if there is no process left
+    """
+    try:
+        if group:
+            os.killpg(process.pid, signum)
+        elif process.returncode is None:
+            os.kill(process.pid, signum)
+        else:
+            return False
         return True
-    print(f"{Fore.RED}ERROR{Fore.RESET} {label}")
-    if retry > 0:
-        sleep(retry_delay)
-        return execute(command, label, retry - 1, verbose=verbose)
-    return False
+    except ProcessLookupError:
+        return False
+
+
+async def terminate(process: asyncio.subprocess.Process, group: bool = True):
+    """
+    send SIGTERM to the process group, then SIGKILL if some processes are
+    still running after a delay
+    """
+    if signal_group(process, signal.SIGTERM, group):
+        deadline = monotonic() + KILL_DELAY
+        while signal_group(process, 0, group):
+            if monotonic() >= deadline:
+                signal_group(process, signal.SIGKILL, group)
+                break
+            await asyncio.sleep(0.1)
+    await process.wait()
+
+
+def arg_max() -> int:
+    """
+    space available for the arguments of a command, like xargs keep 2048
+    bytes of headroom after the environment
+    """
+    env = sum(len(k) + len(v) + 2 + ARG_POINTER for k, v in os.environb.items())
+    return os.sysconf("SC_ARG_MAX") - env - 2048
+
+
+def arg_size(arg: str) -> int:
+    return len(os.fsencode(arg)) + 1 + ARG_POINTER
+
+
+def batches(items: Iterable, max_args: int, max_chars: int) -> Iterator[list]:
+    """
+    group the (count, line) items in batches of at most max_args items whose
+    arguments size is at most max_chars
+    """
+    batch, size = [], 0
+    for count, line in items:
+        if batch and size + arg_size(line) > max_chars:
+            yield batch
+            batch, size = [], 0
+        batch.append((count, line))
+        size += arg_size(line)
+        # yield full batches right away, the next item may take a while
+        if len(batch) >= max_args:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+
+def print_log(log: list):
+    for stream, text in log:
+        if text:
+            stream.write(text)
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+
+async def finished(pending: deque, ordered: bool, limit: int = 0):
+    """
+    pop the finished jobs while more than limit jobs are pending, in input
+    order or as they complete
+    """
+    while pending:
+        if ordered:
+            if len(pending) <= limit and not pending[0][-1].done():
+                return
+            await asyncio.wait([pending[0][-1]])
+            yield pending.popleft()
+        else:
+            done = {p[-1] for p in pending if p[-1].done()}
+            if not done and len(pending) > limit:
+                done, _ = await asyncio.wait(
+                    [p[-1] for p in pending], return_when=asyncio.FIRST_COMPLETED
+                )
+            if not done:
+                return
+            for item in [p for p in pending if p[-1] in done]:
+                pending.remove(item)
+                yield item
+
+
+def feed(loop: asyncio.AbstractEventLoop, queue: asyncio.Queue, work: Iterator):
+    """
+    read the batches in a thread, for inputs which can block like fifos
+    """
+    for batch in work:
+        loop.call_soon_threadsafe(queue.put_nowait, batch)
+    loop.call_soon_threadsafe(queue.put_nowait, None)
+
+
+async def run(args, done: DoneJournal):
+    bucket = TokenBucket(args.rate, args.burst) if args.rate else None
+    slots = asyncio.Semaphore(args.jobs)
+    max_chars = min(args.max_chars or arg_max(), arg_max()) - sum(
+        map(arg_size, args.command)
+    )
+    # work waiting to be run again, as (ready_at, counts, lines, attempt)
+    pending, retries = deque(), []
+
+    def handle(prefix: str, label: str, counts, lines, attempt: int, result):
+        ok, log = result
+        print_log(log)
+        if ok:
+            for line in lines:
+                done.add(line)
+        elif len(lines) > 1:
+            # bisect the batch to find the failing items
+            middle = len(lines) // 2
+            for part in (slice(None, middle), slice(middle, None)):
+                heappush(retries, (monotonic(), counts[part], lines[part], attempt))
+            print(f"{prefix} {Fore.CYAN}SPLIT{Fore.RESET} {label}")
+        elif attempt < args.retry:
+            delay = backoff(attempt, args.retry_delay, args.retry_max_delay)
+            heappush(retries, (monotonic() + delay, counts, lines, attempt + 1))
+            print(
+                f"{prefix} {Fore.CYAN}RETRY{Fore.RESET} in {delay:.1f} seconds {label}"
+            )
+
+    async def collect(limit: int):
+        async for *item, job in finished(pending, args.ordered, limit):
+            handle(*item, job.result())
+
+    async def limited(*params, **kwargs):
+        async with slots:
+            # take the token when the command really starts
+            if bucket is not None:
+                await bucket.acquire()
+            return await execute(*params, **kwargs)
+
+    with args.items.open() as fp:
+        content = my_filter(fp) if args.follow else list(my_filter(fp.readlines()))
+        total = f"/{len(content)}" if isinstance(content, list) else ""
+
+        def todo():
+            for count, line in enumerate(content, start=1):
+                prefix = f"[{count}{total}]"
+                label = (
+                    Fore.YELLOW
+                    + " ".join(map(shlex.quote, args.command + [line]))
+                    + Fore.RESET
+                )
+                if args.skip > 0:
+                    print(f"{prefix} {Fore.CYAN}SKIP{Fore.RESET} {label}")
+                    args.skip -= 1
+                elif line in done:
+                    print(f"{prefix} {Fore.CYAN}IGNORE{Fore.RESET} {label}")
+                else:
+                    yield count, line
+
+        work = batches(todo(), args.max_args, max_chars)
+        if args.follow:
+            queue = asyncio.Queue()
+            Thread(
+                target=feed, args=(asyncio.get_running_loop(), queue, work), daemon=True
+            ).start()
+            getter = None
+
+            async def next_batch():
+                """
+                wait for the next batch, but return WAITING as soon as a
+                command completes or a retry is ready
+                """
+                nonlocal getter
+                if getter is None:
+                    getter = asyncio.ensure_future(queue.get())
+                await asyncio.wait(
+                    [getter, *(p[-1] for p in pending)],
+                    timeout=max(0, retries[0][0] - monotonic()) if retries else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not getter.done():
+                    return WAITING
+                batch, getter = getter.result(), None
+                return batch
+
+        else:
+
+            async def next_batch():
+                return next(work, None)
+
+        exhausted = False
+        while True:
+            if retries and retries[0][0] <= monotonic():
+                _, counts, lines, attempt = heappop(retries)
+            else:
+                batch = None if exhausted else await next_batch()
+                if batch is WAITING:
+                    # print finished commands, they may add retries
+                    await collect(len(pending))
+                    continue
+                if batch is None:
+                    exhausted = True
+                    # input is exhausted, wait for running commands and retries
+                    if pending:
+                        await collect(len(pending) - 1)
+                    elif retries:
+                        await asyncio.sleep(max(0, retries[0][0] - monotonic()))
+                    else:
+                        break
+                    continue
+                counts, lines = map(tuple, zip(*batch))
+                attempt = 0
+            prefix = (
+                f"[{counts[0]}{total}]"
+                if len(counts) == 1
+                else f"[{counts[0]}-{counts[-1]}{total}]"
+            )
+            command = args.command + list(lines)
+            label = Fore.YELLOW + " ".join(map(shlex.quote, command)) + Fore.RESET
+            if attempt == 0:
+                await transition(
+                    prefix,
+                    label,
+                    args.interactive,
+                    args.delay if counts[0] > 1 else 0,
+                )
+            log_path = (
+                args.log_dir / f"{prefix[1:-1].split('/')[0]}.log"
+                if args.log_dir is not None
+                else None
+            )
+            item = (prefix, label, counts, lines, attempt)
+            if args.jobs <= 1:
+                result = await limited(
+                    command, label, timeout=args.timeout, log_path=log_path
+                )
+                handle(*item, result)
+            else:
+                job = asyncio.ensure_future(
+                    limited(
+                        command,
+                        f"{prefix} {label}",
+                        capture=True,
+                        timeout=args.timeout,
+                        log_path=log_path,
+                    )
+                )
+                pending.append((*item, job))
+                # keep a bounded number of commands in flight
+                await collect(2 * args.jobs)
 
 
 if __name__ == "__main__":
@@ -112,54 +563,94 @@ if __name__ == "__main__":
         metavar="N",
         type=int,
         default=3,
-        help="retry N times in case of error (default is 0)",
+        help="retry N times in case of error (default is 3)",
+    )
+    parser.add_argument(
+        "--retry-delay",
+        metavar="SECONDS",
+        type=float,
+        default=1,
+        help="base delay before retrying, doubled at each retry and jittered (default is 1)",
+    )
+    parser.add_argument(
+        "--retry-max-delay",
+        metavar="SECONDS",
+        type=float,
+        default=60,
+        help="maximum delay before retrying (default is 60)",
+    )
+    parser.add_argument(
+        "--rate",
+        metavar="R",
+        type=float,
+        help="execute at most R commands per second",
+    )
+    parser.add_argument(
+        "--burst",
+        metavar="B",
+        type=int,
+        default=1,
+        help="with --rate, allow bursts of B commands (default is 1)",
+    )
+    parser.add_argument(
+        "-n",
+        "--max-args",
+        metavar="N",
+        type=int,
+        default=1,
+        help="give up to N items to each command, failing batches are split to find the failing items (default is 1)",
+    )
+    parser.add_argument(
+        "-s",
+        "--max-chars",
+        metavar="N",
+        type=int,
+        help="with --max-args, limit the command line to N bytes (default is ARG_MAX minus the environment)",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        type=int,
+        default=1,
+        help="execute N commands in parallel, their output is captured (default is 1)",
+    )
+    parser.add_argument(
+        "--completion-order",
+        dest="ordered",
+        action="store_false",
+        help="with --jobs, print the output of commands as they complete instead of in input order",
+    )
+    parser.add_argument(
+        "--timeout",
+        metavar="SECONDS",
+        type=float,
+        help=f"terminate commands running for more than SECONDS, killed {KILL_DELAY} seconds later if still running",
+    )
+    parser.add_argument(
+        "--log-dir",
+        metavar="DIR",
+        type=Path,
+        help="write the output of each command in DIR/N.log, N being the item number",
     )
     parser.add_argument(
         "items", type=Path, metavar="FILE", help="file containing elements to open"
     )
     args = parser.parse_args()
+    if args.log_dir is not None:
+        args.log_dir.mkdir(parents=True, exist_ok=True)
 
-    done_list = []
-
-    if args.done_file is not None and args.done_file.is_file():
-        with args.done_file.open() as fp:
-            for line in my_filter(fp):
-                if line not in done_list:
-                    done_list.append(line)
-        print(
-            f"Load {len(done_list)} items from {Fore.MAGENTA}{args.done_file}{Fore.RESET}"
-        )
+    done = DoneJournal(args.done_file)
+    if len(done) > 0:
+        print(f"Load {len(done)} items from {Fore.MAGENTA}{args.done_file}{Fore.RESET}")
 
     try:
-        count = 1
-        with args.items.open() as fp:
-            content = my_filter(fp) if args.follow else list(my_filter(fp.readlines()))
-            for line in content:
-                prefix = (
-                    f"[{count}/{len(content)}]"
-                    if isinstance(content, list)
-                    else f"[{count}]"
-                )
-                command = args.command + [line]
-                label = Fore.YELLOW + " ".join(map(shlex.quote, command)) + Fore.RESET
-                if args.skip > 0:
-                    print(f"{prefix} {Fore.CYAN}SKIP{Fore.RESET} {label}")
-                    args.skip -= 1
-                elif line in done_list:
-                    print(f"{prefix} {Fore.CYAN}IGNORE{Fore.RESET} {label}")
-                else:
-                    transition(
-                        prefix, label, args.interactive, args.delay if count > 1 else 0
-                    )
-                    if execute(command, label, args.retry, verbose=True):
-                        done_list.append(line)
-                count += 1
+        asyncio.run(run(args, done))
     except KeyboardInterrupt:
         pass
     finally:
-        if len(done_list) > 0 and args.done_file is not None:
-            with args.done_file.open("w") as fp:
-                fp.write("\n".join(done_list))
+        done.close()
+        if len(done) > 0 and args.done_file is not None:
             print(
-                f"Save {len(done_list)} items in {Fore.MAGENTA}{args.done_file}{Fore.RESET}"
+                f"Save {len(done)} items in {Fore.MAGENTA}{args.done_file}{Fore.RESET}"
             )
@@ -1,27 +1,116 @@
 #!/usr/bin/python3
 
+import ctypes
+import errno
+import fcntl
+import operator
+import os
+import re
+import select
 import shutil
 import sys
+import threading
 from argparse import ONE_OR_MORE, ArgumentParser
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import datetime
+from fnmatch import translate
 from pathlib import Path
+from struct import calcsize, unpack_from
+from time import perf_counter, sleep, time
+from typing import Callable, Iterable, Iterator, List, Optional, Pattern, Tuple
 
 from colorama import Fore, Style
+from Levenshtein import distance
 
 ICON_OK = "✅"
 ICON_ERROR = "🚩"
 ICON_EXC = "💥"
 ICON_UNKNOWN = "❓"
 ICON_DRYRUN = "🙈"
+ICON_FUZZY = "🔎"
+
+BUFFER_SIZE = 1 << 20
+FICLONE = 0x40049409
+POLL_INTERVAL = 2
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = "iIII"
+
+RULE_PREDICATE = re.compile(r"(size|mtime)(<=|>=|<|>)(\d+)([a-zA-Z]?)")
+OPERATORS = {"<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+UNITS = {
+    "size": {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30},
+    "mtime": {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800},
+}
+
+
+def clone(source: Path, dest: Path) -> str:
+    """
+    copy the content of a file trying a reflink, then copy_file_range, then a
+    buffered copy, returns the strategy used
+    """
+    with source.open("rb") as src, dest.open("xb") as dst:
+        try:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return "reflink"
+            except OSError:
+                pass
+            copied = 0
+            try:
+                # do not trust st_size, some files like in /proc report 0
+                while True:
+                    count = os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30)
+                    if count == 0:
+                        break
+                    copied += count
+                if copied > 0:
+                    return "copy_file_range"
+            except (AttributeError, OSError) as e:
+                # like shutil, only fall back if nothing was copied yet
+                if copied > 0 or (
+                    isinstance(e, OSError)
+                    and e.errno
+                    not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+                ):
+                    raise
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+            shutil.copyfileobj(src, dst, BUFFER_SIZE)
+            return "buffered copy"
+        except BaseException:
+            dest.unlink()
+            raise
 
 
 def move(source, dest):
     assert source.exists() and not dest.exists()
-    shutil.move(source, dest)
+    try:
+        os.rename(source, dest)
+        return "rename"
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    strategy = clone(source, dest)
+    shutil.copystat(source, dest)
+    source.unlink()
+    return strategy
 
 
 def copy(source, dest):
     assert source.exists() and not dest.exists()
-    shutil.copy(source, dest)
+    strategy = clone(source, dest)
+    shutil.copymode(source, dest)
+    return strategy
 
 
 def link(source, dest):
@@ -29,6 +118,541 @@ def link(source, dest):
     dest.symlink_to(source.resolve())
 
 
+def hardlink(source, dest):
+    assert source.exists() and not dest.exists()
+    os.link(source, dest)
+
+
+class PrefixIndex:
+    """
+    trie of folder names, to find the longest folder name prefixing a filename
+    in O(len(filename)) whatever the number of folders
+    """
+
+    def __init__(self, folders: Iterable[Path] = ()):
+        self.root = {}
+        for folder in folders:
+            self.add(folder)
+
+    def add(self, folder: Path):
+        node = self.root
+        for char in folder.name:
+            node = node.setdefault(char, {})
+        node[None] = folder
+
+    def discard(self, folder: Path):
+        node = self.root
+        for char in folder.name:
+            node = node.get(char)
+            if node is None:
+                return
+        node.pop(None, None)
+
+    def lookup(self, name: str) -> Optional[Path]:
+        node, out = self.root, None
+        for char in name:
+            node = node.get(char)
+            if node is None:
+                break
+            out = node.get(None, out)
+        return out
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree, to find the words close to a word without computing
+    the distance to every word
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, word: str, value):
+        if self.root is None:
+            self.root = [word, value, {}]
+            return
+        node = self.root
+        while True:
+            d = distance(word, node[0])
+            if d == 0:
+                node[1] = value
+                return
+            if d not in node[2]:
+                node[2][d] = [word, value, {}]
+                return
+            node = node[2][d]
+
+    def discard(self, word: str):
+        node = self.root
+        while node is not None:
+            d = distance(word, node[0])
+            if d == 0:
+                node[1] = None
+                return
+            node = node[2].get(d)
+
+    def search(self, word: str, maxdist: int) -> Iterator[Tuple[int, object]]:
+        """
+        yield (distance, value) for the words at most maxdist from word
+        """
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            d = distance(word, node[0])
+            if d <= maxdist and node[1] is not None:
+                yield d, node[1]
+            # triangle inequality, only these children can be close enough
+            for child_distance, child in node[2].items():
+                if d - maxdist <= child_distance <= d + maxdist:
+                    stack.append(child)
+
+
+class FuzzyIndex:
+    """
+    folder names indexed in one BK-tree per name length, a filename is
+    compared to the folder names using its prefixes of the same length, give
+    or take maxdist characters, so that insertions and deletions count too
+    """
+
+    def __init__(self, folders: Iterable[Path] = ()):
+        self.trees = defaultdict(BKTree)
+        for folder in folders:
+            self.add(folder)
+
+    def add(self, folder: Path):
+        self.trees[len(folder.name)].add(folder.name, folder)
+
+    def discard(self, folder: Path):
+        if len(folder.name) in self.trees:
+            self.trees[len(folder.name)].discard(folder.name)
+
+    def lookup(self, name: str, maxdist: int) -> Optional[Path]:
+        """
+        closest folder, the longest one when several are as close
+        """
+        found = [
+            (d, -length, str(folder), folder)
+            for length, tree in self.trees.items()
+            # names not longer than maxdist would be close to anything
+            if maxdist < length <= len(name) + maxdist
+            for size in range(length - maxdist, min(length + maxdist, len(name)) + 1)
+            for d, folder in tree.search(name[:size], maxdist)
+        ]
+        return min(found)[-1] if found else None
+
+
+def linear_lookup(folders: Iterable[Path], name: str) -> Optional[Path]:
+    """
+    find the longest folder name prefixing a filename by scanning all folders
+    """
+    return max(
+        [d for d in folders if name.startswith(d.name)],
+        key=lambda x: len(x.name),
+        default=None,
+    )
+
+
+def benchmark(folders: Iterable[Path], files: Iterable[Path]):
+    """
+    compare the linear scan with the prefix index on the given files
+    """
+    folders, names = list(folders), [f.name for f in files]
+    start = perf_counter()
+    expected = [linear_lookup(folders, n) for n in names]
+    linear = perf_counter() - start
+    start = perf_counter()
+    index = PrefixIndex(folders)
+    build = perf_counter() - start
+    start = perf_counter()
+    found = [index.lookup(n) for n in names]
+    trie = perf_counter() - start
+    assert [str(p) for p in found] == [str(p) for p in expected]
+    print(
+        f"{len(names)} file{plural(len(names))}, {len(folders)} folder{plural(len(folders))}"
+    )
+    print(f"  linear scan:  {linear:.3f}s")
+    print(f"  prefix index: {build + trie:.3f}s ({build:.3f}s to build)")
+    print(f"  speedup:      x{linear / max(build + trie, 1e-9):.0f}")
+
+
+@dataclass
+class Rule:
+    """
+    routing rule, the regex matches the whole filename and every filename
+    it matches starts with the literal prefix, ends with the literal suffix
+    and has one of the extensions when they are given
+    """
+
+    line: str
+    regex: Pattern
+    destination: str
+    prefix: str = ""
+    suffix: str = ""
+    extensions: Tuple[str, ...] = ()
+    predicates: List[Tuple[str, Callable, int]] = field(default_factory=list)
+    hits: int = 0
+
+    @staticmethod
+    def parse(line: str) -> "Rule":
+        """
+        parse a line like 'glob:INV_*.pdf size<10M mtime<7d invoices/{mtime:%Y}'
+        """
+        pattern, *predicates = line.split()
+        if not predicates:
+            raise ValueError("missing destination")
+        destination = predicates.pop()
+        kind, _, pattern = pattern.partition(":")
+        prefix, suffix, extensions = "", "", ()
+        if kind == "glob":
+            prefix = re.match(r"[^*?[]*", pattern).group()
+            suffix = re.search(r"[^*?[\]]*$", pattern).group() if not prefix else ""
+            regex = translate(pattern)
+        elif kind == "ext":
+            extensions = tuple(e.lower() for e in pattern.split(","))
+            regex = rf".*\.(?i:{'|'.join(map(re.escape, pattern.split(',')))})"
+        elif kind == "regex":
+            prefix = re.match(r"\^?([^.^$*+?{}\[\]\\|()]*)", pattern).group(1)
+            following = pattern[len(prefix) + pattern.startswith("^") :][:1]
+            if "|" in pattern:
+                prefix = ""
+            elif following and following in "*?{":
+                # the last literal character is optional
+                prefix = prefix[:-1]
+            regex = f"(?:{pattern}).*"
+        else:
+            raise ValueError(f"unknown rule kind '{kind}'")
+        out = Rule(
+            line,
+            re.compile(regex, re.DOTALL),
+            destination,
+            prefix=prefix,
+            suffix=suffix,
+            extensions=extensions,
+        )
+        for predicate in predicates:
+            match = RULE_PREDICATE.fullmatch(predicate)
+            if match is None or match.group(4) not in UNITS[match.group(1)]:
+                raise ValueError(f"invalid predicate '{predicate}'")
+            name, op, value, unit = match.groups()
+            out.predicates.append((name, OPERATORS[op], int(value) * UNITS[name][unit]))
+        return out
+
+    def accept(self, st: os.stat_result) -> bool:
+        for name, op, value in self.predicates:
+            if not op(st.st_size if name == "size" else time() - st.st_mtime, value):
+                return False
+        return True
+
+
+class Rules:
+    """
+    routing rules indexed by their literal prefix, literal suffix or
+    extensions, so only the rules which can match a filename are tried, the
+    first matching rule whose predicates are verified gives the destination
+    """
+
+    def __init__(self, rules: List[Rule]):
+        self.rules = rules
+        # tries of prefixes and reversed suffixes, rules without any of them
+        # are at the root of the prefixes trie and tried for every file
+        self.prefixes, self.suffixes, self.extensions = {}, {}, defaultdict(list)
+        for index, rule in enumerate(rules):
+            if rule.extensions:
+                for extension in rule.extensions:
+                    self.extensions[extension].append(index)
+            elif rule.suffix:
+                Rules.insert(self.suffixes, reversed(rule.suffix), index)
+            else:
+                Rules.insert(self.prefixes, rule.prefix, index)
+
+    @staticmethod
+    def insert(root: dict, key: Iterable[str], index: int):
+        node = root
+        for char in key:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(index)
+
+    @staticmethod
+    def walk(root: dict, key: Iterable[str]) -> List[int]:
+        """
+        indexes of the rules whose key is a prefix of the given key
+        """
+        node, out = root, list(root.get(None, []))
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                break
+            out += node.get(None, [])
+        return out
+
+    @staticmethod
+    def load(file: Path) -> "Rules":
+        rules = []
+        for number, line in enumerate(file.read_text().splitlines(), start=1):
+            line = line.strip()
+            if line and not line.startswith("#"):
+                try:
+                    rules.append(Rule.parse(line))
+                except (ValueError, re.error) as e:
+                    raise ValueError(f"{file}:{number}: {e}") from e
+        return Rules(rules)
+
+    def candidates(self, name: str) -> List[int]:
+        """
+        indexes of the rules which can match the name, in order
+        """
+        out = Rules.walk(self.prefixes, name) + Rules.walk(
+            self.suffixes, reversed(name)
+        )
+        lower = name.lower()
+        for position, char in enumerate(lower):
+            if char == ".":
+                out += self.extensions.get(lower[position + 1 :], [])
+        return sorted(out)
+
+    def lookup(self, source: Path) -> Optional[Tuple[Rule, str]]:
+        st = None
+        for index in self.candidates(source.name):
+            rule = self.rules[index]
+            match = rule.regex.fullmatch(source.name)
+            if match is None:
+                continue
+            st = st or source.stat()
+            if rule.accept(st):
+                return rule, rule.destination.format(
+                    name=source.name,
+                    stem=source.stem,
+                    ext=source.suffix[1:],
+                    mtime=datetime.fromtimestamp(st.st_mtime),
+                    **match.groupdict(),
+                )
+        return None
+
+
+class Inotify:
+    """
+    minimal inotify binding using ctypes
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self.watches = {}
+
+    def add(self, folder: Path, mask: int):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch {folder}")
+        self.watches[wd] = folder
+
+    def events(self) -> Iterator[Tuple[Optional[Path], str, int]]:
+        """
+        wait for events and yield them as (folder, name, mask)
+        """
+        select.select([self.fd], [], [])
+        data = os.read(self.fd, 1 << 16)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = unpack_from(INOTIFY_EVENT, data, offset)
+            offset += calcsize(INOTIFY_EVENT)
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            yield self.watches.get(wd), name, mask
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Dispatcher:
+    """
+    dispatch files in the subfolders of the output folder
+    """
+
+    def __init__(
+        self,
+        output: Path,
+        operation: Callable,
+        jobs: int,
+        dryrun: bool,
+        rules: Optional[Rules] = None,
+        fuzzy: Optional[int] = None,
+    ):
+        self.output, self.operation, self.dryrun = output, operation, dryrun
+        self.rules, self.fuzzy = rules, fuzzy
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.lock = threading.Lock()
+        self.planned, self.pending = set(), set()
+        self.count_ok, self.count_nodest, self.count_error = 0, 0, 0
+        self.count_fuzzy = 0
+        self.refresh()
+
+    def refresh(self):
+        folders = [d for d in self.output.iterdir() if d.is_dir()]
+        self.index = PrefixIndex(folders)
+        self.fuzzy_index = FuzzyIndex(folders) if self.fuzzy is not None else None
+
+    def add_folder(self, folder: Path):
+        self.index.add(folder)
+        if self.fuzzy_index is not None:
+            self.fuzzy_index.add(folder)
+
+    def discard_folder(self, folder: Path):
+        self.index.discard(folder)
+        if self.fuzzy_index is not None:
+            self.fuzzy_index.discard(folder)
+
+    def submit(self, source: Path):
+        if not source.is_file():
+            return
+        candidate = None
+        if self.rules is not None:
+            try:
+                found = self.rules.lookup(source)
+            except (KeyError, IndexError, ValueError, OSError) as e:
+                with self.lock:
+                    self.count_error += 1
+                print(
+                    f"{ICON_EXC}  cannot apply rules to {label(source)}: {Fore.RED}{e}{Fore.RESET}"
+                )
+                return
+            if found is not None:
+                rule, destination = found
+                rule.hits += 1
+                candidate = self.output / destination
+        if candidate is None:
+            candidate = self.index.lookup(source.name)
+        if candidate is None and self.fuzzy_index is not None:
+            candidate = self.fuzzy_index.lookup(source.name, self.fuzzy)
+            if candidate is not None:
+                with self.lock:
+                    self.count_fuzzy += 1
+                print(
+                    f"{ICON_FUZZY}  {label(source)} approximately matches {label(candidate)}"
+                )
+        if candidate is None:
+            with self.lock:
+                self.count_nodest += 1
+            print(
+                f"{ICON_UNKNOWN}  no subfolder for {label(source)} in {label(self.output)}"
+            )
+            return
+        dest = candidate / source.name
+        with self.lock:
+            if dest in self.planned or dest.exists():
+                self.count_error += 1
+                print(f"{ICON_ERROR}  destination file {label(dest)} already exists")
+                return
+            if self.dryrun:
+                self.count_ok += 1
+                print(
+                    f"{ICON_DRYRUN}  {self.operation.__name__} {label(source)} to {label(candidate)} (dryrun)"
+                )
+                return
+            self.planned.add(dest)
+            job = self.executor.submit(self.apply, source, dest)
+            self.pending.add(job)
+        job.add_done_callback(lambda job: self.done(job, source, candidate, dest))
+
+    def apply(self, source: Path, dest: Path):
+        # rules can target folders that do not exist yet
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        return self.operation(source, dest)
+
+    def done(self, job: Future, source: Path, candidate: Path, dest: Path):
+        with self.lock:
+            self.planned.discard(dest)
+            self.pending.discard(job)
+            try:
+                strategy = job.result()
+                self.count_ok += 1
+                print(
+                    f"{ICON_OK}  {self.operation.__name__} {label(source)} to {label(candidate)}"
+                    + (f" ({strategy})" if strategy else "")
+                )
+            except BaseException as e:
+                self.count_error += 1
+                print(
+                    f"{ICON_EXC}  cannot {self.operation.__name__} {label(source)} to {label(candidate)}: {Fore.RED}{e}{Fore.RESET}"
+                )
+
+    def close(self):
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+        self.executor.shutdown()
+
+
+def watch(dispatcher: Dispatcher, inboxes: Iterable[Path], inotify: Inotify):
+    """
+    dispatch files as soon as they are written or moved in the inbox folders,
+    and keep the subfolders index up to date
+    """
+    output, inboxes = dispatcher.output.resolve(), {i.resolve() for i in inboxes}
+    # a folder can only be watched once, merge the masks if inbox is output
+    masks = defaultdict(int)
+    masks[output] |= IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+    for inbox in inboxes:
+        masks[inbox] |= IN_CLOSE_WRITE | IN_MOVED_TO
+    for folder, mask in masks.items():
+        inotify.add(folder, mask)
+
+    def scan():
+        for inbox in sorted(inboxes):
+            for source in sorted(inbox.iterdir()):
+                dispatcher.submit(source)
+
+    # files already in the inboxes before the watches were set
+    scan()
+    while True:
+        events = list(inotify.events())
+        overflow = any(mask & IN_Q_OVERFLOW for _, _, mask in events)
+        if overflow:
+            dispatcher.refresh()
+        for folder, name, mask in events:
+            if folder == output and mask & IN_ISDIR and not overflow:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    dispatcher.add_folder(dispatcher.output / name)
+                else:
+                    dispatcher.discard_folder(dispatcher.output / name)
+        if overflow:
+            # events were lost, look for the files like at startup
+            scan()
+            continue
+        for folder, name, mask in events:
+            if folder in inboxes and mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                if not mask & IN_ISDIR:
+                    dispatcher.submit(folder / name)
+
+
+def poll(dispatcher: Dispatcher, inboxes: Iterable[Path]):
+    """
+    fallback when inotify is not available, scan the inbox folders regularly
+    and dispatch files whose size and mtime did not change since last scan,
+    each file version is only submitted once
+    """
+    previous, submitted, output_mtime = {}, {}, None
+    while True:
+        if dispatcher.output.stat().st_mtime_ns != output_mtime:
+            output_mtime = dispatcher.output.stat().st_mtime_ns
+            dispatcher.refresh()
+        current = {}
+        for inbox in inboxes:
+            for source in inbox.iterdir():
+                if source.is_file():
+                    st = source.stat()
+                    current[source] = (st.st_size, st.st_mtime_ns)
+        for source in sorted(current):
+            if previous.get(source) == current[source] != submitted.get(source):
+                submitted[source] = current[source]
+                dispatcher.submit(source)
+        # forget files moved away, so that the map does not grow forever
+        submitted = {k: v for k, v in submitted.items() if k in current}
+        previous = current
+        sleep(POLL_INTERVAL)
+
+
 def plural(count: int):
     return "s" if count > 1 else ""
 
@@ -78,56 +702,109 @@ def main():
         const=copy,
         help="copy files instead of moving them",
     )
+    group.add_argument(
+        "-H",
+        "--hardlink",
+        dest="operation",
+        action="store_const",
+        const=hardlink,
+        help="do hard links instead of moving files",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        metavar="N",
+        help="number of files processed in parallel, default is 4",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="compare the linear scan with the prefix index on given files, do not change anything",
+    )
+    parser.add_argument(
+        "-R",
+        "--rules",
+        type=Path,
+        metavar="FILE",
+        help="route files with the rules of the given file before matching subfolder names",
+    )
+    parser.add_argument(
+        "--fuzzy",
+        type=int,
+        metavar="MAXDIST",
+        help="when no subfolder matches, use the closest subfolder name within MAXDIST edits",
+    )
+    parser.add_argument(
+        "-w",
+        "--watch",
+        action="store_true",
+        help="watch the given folders and dispatch files as soon as they are complete",
+    )
     parser.add_argument(
         "files",
         metavar="FILE",
         nargs=ONE_OR_MORE,
         type=Path,
-        help="files to move/copy/link",
+        help="files to move/copy/link, or folders to watch with --watch",
     )
 
     args = parser.parse_args()
 
     dest_folders = [d for d in args.output.iterdir() if d.is_dir()]
-    count_ok, count_nodest, count_error = 0, 0, 0
-    for source in filter(Path.is_file, args.files):
-        candidate = max(
-            [d for d in dest_folders if source.name.startswith(d.name)],
-            key=lambda x: len(x.name),
-            default=None,
-        )
-        if candidate is None:
-            count_nodest += 1
-            print(
-                f"{ICON_UNKNOWN}  no subfolder for {label(source)} in {label(args.output)}"
-            )
+    if args.benchmark:
+        return benchmark(dest_folders, filter(Path.is_file, args.files))
+    if args.watch and not all(map(Path.is_dir, args.files)):
+        parser.error("--watch only accepts folders")
+
+    try:
+        rules = Rules.load(args.rules) if args.rules else None
+    except (OSError, ValueError) as e:
+        parser.error(f"invalid rules: {e}")
+    dispatcher = Dispatcher(
+        args.output, args.operation, args.jobs, args.dryrun, rules, args.fuzzy
+    )
+    try:
+        if not args.watch:
+            for source in filter(Path.is_file, args.files):
+                dispatcher.submit(source)
         else:
-            dest = candidate / source.name
-            if dest.exists():
-                count_error += 1
-                print(f"{ICON_ERROR}  destination file {label(dest)} already exists")
-            elif args.dryrun:
-                count_ok += 1
-                print(
-                    f"{ICON_DRYRUN}  {args.operation.__name__} {label(source)} to {label(candidate)} (dryrun)"
-                )
+            try:
+                inotify = Inotify()
+            except (AttributeError, OSError) as e:
+                print(f"{ICON_EXC}  inotify is not available, polling folders: {e}")
+                inotify = None
+            if inotify is None:
+                poll(dispatcher, args.files)
             else:
                 try:
-                    args.operation(source, dest)
-                    count_ok += 1
-                    print(
-                        f"{ICON_OK}  {args.operation.__name__} {label(source)} to {label(candidate)}"
-                    )
-                except BaseException as e:
-                    count_error += 1
-                    print(
-                        f"{ICON_EXC}  cannot {args.operation.__name__} {label(source)} to {label(candidate)}: {Fore.RED}{e}{Fore.RESET}"
-                    )
+                    watch(dispatcher, args.files, inotify)
+                finally:
+                    inotify.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.close()
 
+    count_ok, count_nodest, count_error = (
+        dispatcher.count_ok,
+        dispatcher.count_nodest,
+        dispatcher.count_error,
+    )
     if count_ok:
         print(
             f"    {ICON_DRYRUN if args.dryrun else ICON_OK} {count_ok} file{plural(count_ok)} {'would be ' if args.dryrun else ''}processed",
         )
+    for rule in rules.rules if rules else []:
+        if rule.hits:
+            print(
+                f"    {ICON_OK} {rule.hits} file{plural(rule.hits)} matched rule {Style.BRIGHT}{rule.line}{Style.RESET_ALL}",
+            )
+    if dispatcher.count_fuzzy:
+        print(
+            f"    {ICON_FUZZY} {dispatcher.count_fuzzy} file{plural(dispatcher.count_fuzzy)} approximately matched",
+        )
     if count_nodest:
         print(
             f"    {ICON_UNKNOWN} {count_nodest} file{plural(count_nodest)} without subfolder",
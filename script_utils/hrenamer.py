@@ -1,15 +1,40 @@
 #!/usr/bin/python3
 
+import fcntl
 import hashlib
+import json
+import math
+import mmap
+import os
 import shutil
+import sqlite3
 import sys
-from argparse import ONE_OR_MORE, ArgumentParser, ArgumentTypeError
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from argparse import ZERO_OR_MORE, ArgumentParser, ArgumentTypeError
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from collections import defaultdict
+from dataclasses import dataclass, replace
+from functools import partial
 from pathlib import Path
-from typing import Callable, Iterable, Optional
+from time import perf_counter
+from typing import Callable, Dict, Iterable, List, Optional, TextIO, Tuple
 
 from colorama import Fore, Style
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
 ICON_OK = "✅"
 ICON_EXISTS = "🚩"
 ICON_ERROR = "💥"
@@ -17,6 +42,64 @@ ICON_HINT = "💡"
 ICON_UNKNOWN = "🚨"
 ICON_DRYRUN = "🙈"
 
+DEFAULT_CHUNK_SIZE = 1 << 20
+CALIBRATION_SIZES = [1 << n for n in range(12, 25, 2)]
+PARTIAL_SIZE = 64 << 10
+FICLONE = 0x40049409
+
+
+@dataclass(frozen=True)
+class HashBackend:
+    """
+    hash algorithm usable to compute fingerprints
+    """
+
+    name: str
+    factory: Callable
+    bits: int
+    chunk_size: int = DEFAULT_CHUNK_SIZE
+    tunable: bool = False
+    secure: bool = True
+
+    def with_digest_size(self, size: int):
+        """
+        blake2 digest size can be chosen, from 1 to the algorithm max size
+        """
+        if not self.tunable:
+            return self
+        if not 0 < size * 8 <= self.bits:
+            raise ValueError(f"Invalid digest size {size} for {self.name}")
+        return replace(
+            self,
+            name=f"{self.name}-{size * 8}",
+            factory=partial(self.factory, digest_size=size),
+            bits=size * 8,
+        )
+
+
+HASH_BACKENDS = {
+    b.name: b
+    for b in (
+        HashBackend("md5", hashlib.md5, 128),
+        HashBackend("sha1", hashlib.sha1, 160),
+        HashBackend("sha224", hashlib.sha224, 224),
+        HashBackend("sha256", hashlib.sha256, 256),
+        HashBackend("sha384", hashlib.sha384, 384),
+        HashBackend("sha512", hashlib.sha512, 512),
+        HashBackend("blake2b", hashlib.blake2b, 512, tunable=True),
+        HashBackend("blake2s", hashlib.blake2s, 256, tunable=True),
+    )
+}
+if xxhash is not None:
+    for backend in (
+        HashBackend("xxh64", xxhash.xxh64, 64, 4 << 20, secure=False),
+        HashBackend("xxh3", xxhash.xxh3_64, 64, 4 << 20, secure=False),
+        HashBackend("xxh128", xxhash.xxh3_128, 128, 4 << 20, secure=False),
+    ):
+        HASH_BACKENDS[backend.name] = backend
+if blake3 is not None:
+    HASH_BACKENDS["blake3"] = HashBackend("blake3", blake3.blake3, 256, 8 << 20)
+
 
 def plural(count: int):
     return "s" if count > 1 else ""
@@ -29,6 +112,20 @@ def noslash(text: str):
     return text
 
 
+def datasize(text: str) -> int:
+    """
+    parse a size like 4096, 64K or 1M
+    """
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    try:
+        if text[-1:].upper() in units:
+            return int(text[:-1]) * units[text[-1:].upper()]
+        return int(text)
+    except ValueError:
+        print(f"{Fore.RED}Invalid size '{text}'{Fore.RESET}")
+        raise ArgumentTypeError()
+
+
 def label(item):
     """
     colorize item given its type
@@ -40,13 +137,93 @@ def label(item):
     return str(item)
 
 
-def visit(files: Iterable[Path], recursive: bool = False, verbose: bool = False):
+def is_rotational(dev: int) -> bool:
+    """
+    tell if a device is a spinning disk, using sysfs
+    """
+    sysfs = Path(f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}")
+    # partitions do not have a queue, use their parent disk
+    for queue in (sysfs / "queue", sysfs / ".." / "queue"):
+        try:
+            return (queue / "rotational").read_text().strip() == "1"
+        except OSError:
+            pass
+    return False
+
+
+class DeviceScheduler:
+    """
+    dispatch jobs to one executor per device, so that spinning disks are
+    read by a single worker while faster devices get all the workers
+    """
+
+    def __init__(self, pool: Callable, workers: int, jobs_per_device: int = 0):
+        self.pool = pool
+        self.workers = workers
+        self.jobs_per_device = jobs_per_device
+        self.executors = {}
+        self.rotational = {}
+
+    def is_rotational(self, dev: int) -> bool:
+        if dev not in self.rotational:
+            self.rotational[dev] = is_rotational(dev)
+        return self.rotational[dev]
+
+    def submit(self, dev: int, fn: Callable, *args):
+        if dev not in self.executors:
+            self.executors[dev] = self.pool(
+                max_workers=self.jobs_per_device
+                or (1 if self.is_rotational(dev) else self.workers)
+            )
+        return self.executors[dev].submit(fn, *args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        for executor in self.executors.values():
+            executor.shutdown()
+
+
+def walk(folder: Path, by_inode: Optional[Callable] = None):
+    """
+    yield files of a folder and its subfolders with their stat, using
+    os.scandir without sorting nor recursion so that huge trees are streamed.
+    Folders on devices for which by_inode(dev) is true are read in inode
+    order, which is closer to the physical order on spinning disks
+    """
+    stack = [folder]
+    while stack:
+        # list a whole folder before yielding, files may be renamed meanwhile
+        current = stack.pop()
+        with os.scandir(current) as iterator:
+            entries = list(iterator)
+        if entries and by_inode is not None and by_inode(os.stat(current).st_dev):
+            entries.sort(key=os.DirEntry.inode)
+        for entry in entries:
+            if entry.is_file():
+                yield Path(entry.path), entry.stat()
+            elif entry.is_dir():
+                stack.append(entry.path)
+            else:
+                print(
+                    f"{ICON_UNKNOWN} {label(Path(entry.path))} is ignored, not a file nor a directory"
+                )
+
+
+def visit(
+    files: Iterable[Path],
+    recursive: bool = False,
+    verbose: bool = False,
+    by_inode: Optional[Callable] = None,
+):
+    regular_files = []
     for file in sorted(filter(lambda x: isinstance(x, Path), files)):
         if file.is_file():
-            yield file
+            regular_files.append((file, file.stat()))
         elif file.is_dir():
             if recursive:
-                yield from visit(file.iterdir(), recursive=recursive)
+                yield from walk(file, by_inode=by_inode)
             else:
                 if verbose:
                     print(
@@ -56,16 +233,581 @@ def visit(files: Iterable[Path], recursive: bool = False, verbose: bool = False)
             print(
                 f"{ICON_UNKNOWN} {label(file)} is ignored, not a file nor a directory"
             )
+    if by_inode is not None:
+        regular_files.sort(
+            key=lambda x: (x[1].st_dev, x[1].st_ino if by_inode(x[1].st_dev) else 0)
+        )
+    yield from regular_files
+
+
+def compute_hashes(
+    hfuncs: Iterable[Callable],
+    file: Path,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    use_mmap: bool = False,
+) -> List[str]:
+    """
+    compute several fingerprints of a file in a single pass, reading it by
+    large chunks in a reused buffer, or through a memory mapping
+    """
+    algos = [hfunc() for hfunc in hfuncs]
+    with file.resolve().open("rb", buffering=0) as fp:
+        if use_mmap:
+            size = os.fstat(fp.fileno()).st_size
+            if size > 0:
+                with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mm, "madvise"):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    with memoryview(mm) as view:
+                        for offset in range(0, size, chunk_size):
+                            for algo in algos:
+                                algo.update(view[offset : offset + chunk_size])
+        else:
+            buffer = bytearray(chunk_size)
+            with memoryview(buffer) as view:
+                for count in iter(lambda: fp.readinto(buffer), 0):
+                    for algo in algos:
+                        algo.update(view[:count])
+    return [algo.hexdigest() for algo in algos]
+
+
+def compute_hash(
+    hfunc: Callable,
+    file: Path,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    use_mmap: bool = False,
+) -> str:
+    """
+    compute the fingerprint of a file
+    """
+    return compute_hashes([hfunc], file, chunk_size=chunk_size, use_mmap=use_mmap)[0]
+
+
+def sample_data(total: int) -> memoryview:
+    """
+    random data used to measure hash functions throughput
+    """
+    return memoryview(bytearray(os.urandom(1 << 20)) * (total >> 20))
+
+
+def throughput(hfunc: Callable, data: memoryview, chunk_size: int) -> float:
+    """
+    hash the given data by chunks and return the time spent
+    """
+    algo = hfunc()
+    start = perf_counter()
+    for offset in range(0, len(data), chunk_size):
+        algo.update(data[offset : offset + chunk_size])
+    return perf_counter() - start
+
+
+def calibrate(hfunc: Callable, total: int = 64 << 20) -> int:
+    """
+    find the chunk size giving the best throughput for the given hash function
+    """
+    data = sample_data(total)
+    return min(CALIBRATION_SIZES, key=lambda size: throughput(hfunc, data, size))
+
+
+def benchmark(backends: Iterable[HashBackend], count: int, length: int = 0):
+    """
+    compare hash backends throughput and collision probability for count files
+    """
+    data = sample_data(256 << 20)
+    for backend in backends:
+        elapsed = throughput(backend.factory, data, backend.chunk_size)
+        bits = min(backend.bits, length * 4) if length > 0 else backend.bits
+        # birthday bound
+        collision = min(1.0, count * (count - 1) / 2 / 2**bits)
+        print(
+            f"{ICON_HINT} {backend.name:>12}: {Fore.YELLOW}{len(data) / elapsed / (1 << 20):8.0f} MiB/s{Fore.RESET}"
+            f" {bits:>4} bits, collision probability for {count} files: {Fore.CYAN}{collision:.1e}{Fore.RESET}"
+            + ("" if backend.secure else f" {Fore.RED}(not cryptographic){Fore.RESET}")
+        )
+
+
+def cache_dir() -> Path:
+    """
+    folder where persistent data is cached, following XDG specification
+    """
+    return Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache") / "script-utils"
+
+
+class FingerprintCache:
+    """
+    persistent cache of fingerprints, keyed by file identity: as long as the
+    device, inode, size and modification time are unchanged, the file content
+    is considered unchanged and is not read again
+    """
+
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, dbfile: Path):
+        dbfile.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(dbfile))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints ("
+            "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+            "algorithm TEXT, digest TEXT, path TEXT, "
+            "PRIMARY KEY (dev, ino, size, mtime_ns, algorithm))"
+        )
+        self.pending = 0
+
+    @staticmethod
+    def identity(st: os.stat_result):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def get(self, st: os.stat_result, algorithm: str) -> Optional[str]:
+        row = self.db.execute(
+            "SELECT digest FROM fingerprints "
+            "WHERE dev=? AND ino=? AND size=? AND mtime_ns=? AND algorithm=?",
+            (*self.identity(st), algorithm),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, st: os.stat_result, algorithm: str, digest: str, file: Path):
+        self.db.execute(
+            "INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (*self.identity(st), algorithm, digest, str(file)),
+        )
+        self.pending += 1
+        if self.pending >= self.COMMIT_INTERVAL:
+            self.commit()
+
+    def relocate(self, st: os.stat_result, file: Path):
+        """
+        update the path of a cached file, after it was renamed
+        """
+        self.db.execute(
+            "UPDATE fingerprints SET path=? "
+            "WHERE dev=? AND ino=? AND size=? AND mtime_ns=?",
+            (str(file), *self.identity(st)),
+        )
+
+    def prune(self) -> int:
+        """
+        remove entries whose file was deleted or modified
+        """
+        stale = []
+        for rowid, path, *identity in self.db.execute(
+            "SELECT rowid, path, dev, ino, size, mtime_ns FROM fingerprints"
+        ):
+            try:
+                if self.identity(os.stat(path)) != tuple(identity):
+                    stale.append((rowid,))
+            except OSError:
+                stale.append((rowid,))
+        self.db.executemany("DELETE FROM fingerprints WHERE rowid=?", stale)
+        self.commit()
+        return len(stale)
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class Manifest:
+    """
+    write checksums of processed files, either in a format compatible with
+    sha256sum & co or as json lines
+    """
+
+    def __init__(self, fp: TextIO, algorithms: List[str], jsonl: bool = False):
+        self.fp = fp
+        self.algorithms = algorithms
+        self.jsonl = jsonl
+
+    def write(self, file: Path, size: int, digests: Dict[str, str]):
+        if self.jsonl:
+            self.fp.write(
+                json.dumps(
+                    {
+                        "path": str(file),
+                        "size": size,
+                        **{a: digests[a] for a in self.algorithms},
+                    }
+                )
+                + "\n"
+            )
+        elif len(self.algorithms) == 1:
+            self.fp.write(f"{digests[self.algorithms[0]]}  {file}\n")
+        else:
+            # use BSD style lines, which can be checked with cksum -c
+            for algorithm in self.algorithms:
+                self.fp.write(f"{algorithm.upper()} ({file}) = {digests[algorithm]}\n")
 
 
-def compute_hash(hfunc: Callable, file: Path):
+def compute_partial_hash(hfunc: Callable, file: Path, size: int = PARTIAL_SIZE) -> str:
+    """
+    compute the fingerprint of the first and last bytes of a file, which is
+    the full fingerprint for files smaller than twice the given size
+    """
     algo = hfunc()
     with file.resolve().open("rb") as fp:
-        for chunk in iter(lambda: fp.read(4096), b""):
-            algo.update(chunk)
+        algo.update(fp.read(size))
+        end = fp.seek(0, os.SEEK_END)
+        if end > size:
+            fp.seek(max(size, end - size))
+            algo.update(fp.read())
     return algo.hexdigest()
 
 
+def split_groups(
+    groups: List[List[Tuple[Path, os.stat_result]]],
+    scheduler: DeviceScheduler,
+    fn: Callable,
+    lookup: Optional[Callable] = None,
+    store: Optional[Callable] = None,
+) -> List[List[Tuple[Path, os.stat_result]]]:
+    """
+    split groups of files given the result of fn(file), computed in parallel,
+    and only keep the groups having more than one file
+    """
+    buckets = defaultdict(list)
+    jobs = {}
+    candidates = sorted(
+        ((f, st, index) for index, group in enumerate(groups) for f, st in group),
+        key=lambda x: (x[1].st_dev, x[1].st_ino),
+    )
+    for f, st, index in candidates:
+        known = lookup(f, st) if lookup is not None else None
+        if known is not None:
+            buckets[(index, known)].append((f, st))
+        else:
+            jobs[scheduler.submit(st.st_dev, fn, f)] = (index, f, st)
+    for job in as_completed(jobs):
+        index, f, st = jobs[job]
+        if store is not None:
+            store(f, st, job.result())
+        buckets[(index, job.result())].append((f, st))
+    return [sorted(b) for b in buckets.values() if len(b) > 1]
+
+
+def find_duplicates(
+    files: Iterable[Tuple[Path, os.stat_result]],
+    scheduler: DeviceScheduler,
+    hfunc: Callable,
+    full_hash: Callable,
+    lookup: Optional[Callable] = None,
+    store: Optional[Callable] = None,
+) -> List[List[Tuple[Path, os.stat_result]]]:
+    """
+    group files having the same content: files are first grouped by size,
+    then by the fingerprint of their first and last bytes, and only the
+    remaining candidates are fully hashed
+    """
+    by_size = defaultdict(dict)
+    for f, st in files:
+        if st.st_size > 0:
+            # hardlinks to the same file are not duplicates
+            by_size[st.st_size].setdefault((st.st_dev, st.st_ino), (f, st))
+    groups = [list(g.values()) for g in by_size.values() if len(g) > 1]
+    groups = split_groups(groups, scheduler, partial(compute_partial_hash, hfunc))
+    small = [g for g in groups if g[0][1].st_size <= 2 * PARTIAL_SIZE]
+    large = [g for g in groups if g[0][1].st_size > 2 * PARTIAL_SIZE]
+    return small + split_groups(large, scheduler, full_hash, lookup, store)
+
+
+def reflink(source: Path, dest: Path):
+    """
+    clone a file sharing its data blocks, on filesystems supporting it
+    """
+    with source.open("rb") as src, dest.open("xb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except BaseException:
+            dest.unlink()
+            raise
+
+
+def link_duplicate(source: Path, duplicate: Path, linker: Callable):
+    """
+    replace the duplicate with a link to the source, the duplicate is only
+    replaced once the link is created
+    """
+    tmp = duplicate.with_name(f".{duplicate.name}.hrenamer")
+    linker(source, tmp)
+    try:
+        # a reflink is a new file, keep the mode and times of the duplicate,
+        # but do not touch the source through a hard link
+        if not os.path.samefile(source, tmp):
+            shutil.copystat(duplicate, tmp)
+        os.replace(tmp, duplicate)
+    except BaseException:
+        tmp.unlink()
+        raise
+
+
+@dataclass
+class Rename:
+    """
+    file to be renamed, location is updated once renamed
+    """
+
+    source: Path
+    target: Path
+    st: os.stat_result
+    digests: Dict[str, str]
+    location: Optional[Path] = None
+
+    def __post_init__(self):
+        if self.location is None:
+            self.location = self.source
+
+
+def plan_renames(renames: List[Rename], exists: Callable = Path.exists):
+    """
+    resolve conflicts between renames and order them so that nothing is
+    overwritten: a target can be the current name of another renamed file,
+    and cycles are broken using a temporary name.
+    Returns the files already named, the renames in conflict and the list of
+    (source, destination, rename) steps to apply in order
+    """
+    named = [r for r in renames if r.source == r.target]
+    pending = sorted(
+        (r for r in renames if r.source != r.target), key=lambda r: str(r.source)
+    )
+    conflicts = []
+    while True:
+        # a target is free if it does not exist or if its file is renamed
+        by_source = {r.source: r for r in pending}
+        claimed, accepted = set(), []
+        for rename in pending:
+            if rename.target in claimed or (
+                rename.target not in by_source and exists(rename.target)
+            ):
+                conflicts.append(rename)
+            else:
+                claimed.add(rename.target)
+                accepted.append(rename)
+        if len(accepted) == len(pending):
+            break
+        pending = accepted
+
+    steps, done = [], set()
+    for rename in pending:
+        if rename.source in done:
+            continue
+        # renames occupying the target must be applied first
+        chain = [rename]
+        while True:
+            blocker = by_source.get(chain[-1].target)
+            if blocker is None or blocker is rename or blocker.source in done:
+                break
+            chain.append(blocker)
+        if by_source.get(chain[-1].target) is rename:
+            tmp = rename.source.with_name(f".{rename.source.name}.hrenamer")
+            steps.append((rename.source, tmp, rename))
+            steps += [(r.source, r.target, r) for r in reversed(chain[1:])]
+            steps.append((tmp, rename.target, rename))
+        else:
+            steps += [(r.source, r.target, r) for r in reversed(chain)]
+        done.update(r.source for r in chain)
+    return named, conflicts, steps
+
+
+def move(source: Path, dest: Path):
+    """
+    rename a file, using a plain rename on the same device
+    """
+    if dest.exists():
+        raise FileExistsError(f"{dest} already exists")
+    if not dest.parent.exists():
+        dest.parent.mkdir(parents=True)
+    if os.stat(dest.parent).st_dev == os.stat(source).st_dev:
+        os.rename(source, dest)
+    else:
+        shutil.move(source, dest)
+
+
+class Journal:
+    """
+    append-only record of renames, used to undo them. A rename is written
+    before it is applied, and a line marking it aborted is added if it fails
+    """
+
+    FSYNC_INTERVAL = 100
+
+    def __init__(self, file: Path):
+        self.fp = file.open("a")
+        self.count = 0
+
+    def write(self, source: Path, dest: Path, aborted: bool = False):
+        entry = {"source": str(source.absolute()), "target": str(dest.absolute())}
+        if aborted:
+            entry["aborted"] = True
+        self.fp.write(json.dumps(entry) + "\n")
+        self.fp.flush()
+        self.count += 1
+        if self.count % self.FSYNC_INTERVAL == 0:
+            os.fsync(self.fp.fileno())
+
+    def close(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fp.close()
+
+    @staticmethod
+    def read(file: Path) -> List[Tuple[Path, Path]]:
+        out = []
+        with file.open() as fp:
+            for entry in map(json.loads, filter(str.strip, fp)):
+                item = (Path(entry["source"]), Path(entry["target"]))
+                if not entry.get("aborted"):
+                    out.append(item)
+                elif item in out:
+                    # remove the latest matching rename
+                    del out[len(out) - 1 - out[::-1].index(item)]
+        return out
+
+
+def undo(file: Path, dryrun: bool = False):
+    """
+    revert renames recorded in a journal, latest first
+    """
+    count_restored, count_error = 0, 0
+    for source, target in reversed(Journal.read(file)):
+        if not target.exists() and source.exists():
+            # interrupted before the rename was applied
+            continue
+        if dryrun:
+            count_restored += 1
+            print(
+                f"{ICON_DRYRUN} {label(target)} would be restored {label(source)} {Fore.CYAN}(dryrun){Style.RESET_ALL}"
+            )
+            continue
+        try:
+            move(target, source)
+            count_restored += 1
+            print(f"{ICON_OK} {label(target)} was restored {label(source)}")
+        except BaseException as e:
+            count_error += 1
+            print(
+                f"{ICON_ERROR} {label(target)} cannot be restored {label(source)}: {Fore.RED}{e}{Fore.RESET}"
+            )
+    if count_restored:
+        print(
+            f"    {ICON_DRYRUN if dryrun else ICON_OK} {count_restored} file{plural(count_restored)} {'would be ' if dryrun else ''}restored",
+        )
+    if count_error:
+        print(
+            f"    {ICON_ERROR} {count_error} error{plural(count_error)}",
+        )
+
+
+def timed(fn: Callable, *args):
+    """
+    call fn and also return the time spent, usable in a process pool
+    """
+    start = perf_counter()
+    result = fn(*args)
+    return result, perf_counter() - start
+
+
+class RunStats:
+    """
+    throughput and latency figures of a run, with a live progress line
+    """
+
+    PROGRESS_INTERVAL = 0.5
+    SAMPLE_INTERVAL = 1.0
+
+    def __init__(self, progress: bool = False):
+        self.progress = progress
+        self.start = perf_counter()
+        self.files, self.bytes_read = 0, 0
+        self.cache_hits, self.cache_misses = 0, 0
+        self.hash_time, self.rename_time = 0.0, 0.0
+        self.queue_depth, self.max_queue_depth = 0, 0
+        # latency upper bound in ms -> count
+        self.latency = defaultdict(int)
+        # (elapsed seconds, MiB/s) for every sample interval
+        self.throughput = []
+        self.last_sample = (self.start, 0)
+        self.last_progress = self.start
+
+    def queued(self, depth: int):
+        self.queue_depth = depth
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def cached(self):
+        self.files += 1
+        self.cache_hits += 1
+        self.tick()
+
+    def hashed(self, size: int, elapsed: float):
+        self.files += 1
+        self.cache_misses += 1
+        self.bytes_read += size
+        self.hash_time += elapsed
+        self.latency[2 ** math.ceil(math.log2(max(elapsed * 1000, 1)))] += 1
+        self.tick()
+
+    def renamed(self, elapsed: float):
+        self.rename_time += elapsed
+
+    def tick(self):
+        now = perf_counter()
+        sample_time, sample_bytes = self.last_sample
+        if now - sample_time >= self.SAMPLE_INTERVAL:
+            self.throughput.append(
+                (
+                    round(now - self.start, 1),
+                    round(
+                        (self.bytes_read - sample_bytes)
+                        / (now - sample_time)
+                        / (1 << 20),
+                        1,
+                    ),
+                )
+            )
+            self.last_sample = (now, self.bytes_read)
+        if self.progress and now - self.last_progress >= self.PROGRESS_INTERVAL:
+            self.last_progress = now
+            sys.stderr.write(f"\r{ICON_HINT} {self.summary()}\x1b[K")
+            sys.stderr.flush()
+
+    def clear(self):
+        if self.progress:
+            sys.stderr.write("\r\x1b[K")
+            sys.stderr.flush()
+
+    @property
+    def elapsed(self):
+        return perf_counter() - self.start
+
+    @property
+    def cache_hit_rate(self):
+        return self.cache_hits / self.files if self.files else 0.0
+
+    def summary(self):
+        return (
+            f"{self.files} file{plural(self.files)}, {self.bytes_read >> 20} MiB read"
+            f" at {self.bytes_read / self.elapsed / (1 << 20):.0f} MiB/s,"
+            f" queue {self.queue_depth}, cache hits {self.cache_hit_rate:.0%}"
+        )
+
+    def to_json(self):
+        return {
+            "elapsed": round(self.elapsed, 3),
+            "files": self.files,
+            "bytes_read": self.bytes_read,
+            "mib_per_second": round(self.bytes_read / self.elapsed / (1 << 20), 1),
+            "throughput": self.throughput,
+            "latency_ms": {f"<={k}": v for k, v in sorted(self.latency.items())},
+            "max_queue_depth": self.max_queue_depth,
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "cache_hit_rate": round(self.cache_hit_rate, 3),
+            "hash_time": round(self.hash_time, 3),
+            "rename_time": round(self.rename_time, 3),
+        }
+
+
 def compute_filename(
     fingerprint: str,
     length: int = 0,
@@ -81,6 +823,85 @@ def compute_filename(
     )
 
 
+def duplicates(args, backend: HashBackend, cache: Optional[FingerprintCache]):
+    """
+    find duplicates and optionally replace them with links
+    """
+
+    def lookup(f, st):
+        if cache is not None and not args.verify_cache:
+            return cache.get(st, backend.name)
+        return None
+
+    def store(f, st, digest):
+        if cache is not None:
+            cache.put(st, backend.name, digest, f)
+
+    pool = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+    with DeviceScheduler(
+        pool, args.jobs or os.cpu_count() or 1, args.jobs_per_device
+    ) as scheduler:
+        groups = find_duplicates(
+            visit(
+                args.files,
+                recursive=args.recursive,
+                verbose=args.verbose,
+                by_inode=scheduler.is_rotational,
+            ),
+            scheduler,
+            backend.factory,
+            partial(
+                compute_hash,
+                backend.factory,
+                chunk_size=args.chunk_size,
+                use_mmap=args.mmap,
+            ),
+            lookup=lookup,
+            store=store,
+        )
+    if cache is not None:
+        cache.close()
+
+    linker = {"hard": os.link, "reflink": reflink}.get(args.link)
+    count_duplicates, count_linked, count_error, wasted = 0, 0, 0, 0
+    for (source, _), *others in groups:
+        for duplicate, st in others:
+            count_duplicates += 1
+            wasted += st.st_size
+            if linker is None:
+                print(
+                    f"{ICON_EXISTS} {label(duplicate)} is a duplicate of {label(source)}"
+                )
+            elif args.dryrun:
+                count_linked += 1
+                print(
+                    f"{ICON_DRYRUN} {label(duplicate)} would be linked to {label(source)} {Fore.CYAN}(dryrun){Style.RESET_ALL}"
+                )
+            else:
+                try:
+                    link_duplicate(source, duplicate, linker)
+                    count_linked += 1
+                    print(f"{ICON_OK} {label(duplicate)} was linked to {label(source)}")
+                except BaseException as e:
+                    count_error += 1
+                    print(
+                        f"{ICON_ERROR} {label(duplicate)} cannot be linked to {label(source)}: {Fore.RED}{e}{Fore.RESET}"
+                    )
+
+    if count_duplicates:
+        print(
+            f"    {ICON_EXISTS} {count_duplicates} duplicate{plural(count_duplicates)} in {len(groups)} group{plural(len(groups))}, {wasted >> 20} MiB wasted",
+        )
+    if count_linked:
+        print(
+            f"    {ICON_DRYRUN if args.dryrun else ICON_OK} {count_linked} file{plural(count_linked)} {'would be ' if args.dryrun else ''}linked",
+        )
+    if count_error:
+        print(
+            f"    {ICON_ERROR} {count_error} error{plural(count_error)}",
+        )
+
+
 def main():
     parser = ArgumentParser()
     parser.add_argument(
@@ -100,25 +921,66 @@ def main():
         "--jobs",
         type=int,
         metavar="THREADS",
-        help="parallel jobs",
+        help="parallel jobs per device, spinning disks use a single job by default",
+    )
+    parser.add_argument(
+        "--jobs-per-device",
+        type=int,
+        metavar="N",
+        default=0,
+        help="parallel jobs for every device, including spinning disks",
+    )
+    parser.add_argument(
+        "--queue",
+        dest="queue_size",
+        type=int,
+        metavar="N",
+        help="maximum number of files being hashed at once per device, default is 4 times the jobs",
+    )
+    parser.add_argument(
+        "-P",
+        "--processes",
+        action="store_true",
+        help="use a pool of processes instead of threads",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=datasize,
+        metavar="SIZE",
+        help="read files by chunks of SIZE bytes, default depends on the algorithm",
+    )
+    parser.add_argument(
+        "--calibrate",
+        action="store_true",
+        help="measure the hash function throughput to choose the chunk size",
+    )
+    parser.add_argument(
+        "--mmap",
+        action="store_true",
+        help="read files using memory mapping",
     )
     group = parser.add_mutually_exclusive_group()
-    for hlabel, hfunc in (
-        ("md5", hashlib.md5),
-        ("sha1", hashlib.sha1),
-        ("sha224", hashlib.sha224),
-        ("sha256", hashlib.sha256),
-        ("sha384", hashlib.sha384),
-        ("sha512", hashlib.sha512),
-    ):
+    for backend in HASH_BACKENDS.values():
         group.add_argument(
-            f"--{hlabel}",
-            dest="hfunc",
+            f"--{backend.name}",
+            dest="algorithm",
             action="store_const",
-            const=hfunc,
-            default=hashlib.md5,
-            help=f"use {hlabel} to compute file fingerprint",
+            const=backend.name,
+            default="md5",
+            help=f"use {backend.name} to compute file fingerprint",
         )
+    parser.add_argument(
+        "--digest-size",
+        type=int,
+        metavar="BYTES",
+        help="digest size of blake2 algorithms",
+    )
+    parser.add_argument(
+        "--benchmark",
+        type=int,
+        metavar="COUNT",
+        help="compare algorithms throughput and collision probability for COUNT files, then exit",
+    )
 
     parser.add_argument(
         "-r",
@@ -162,61 +1024,304 @@ def main():
         type=Path,
         help="rename files in specific folder",
     )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        metavar="FILE",
+        help="write checksums of processed files to FILE",
+    )
+    parser.add_argument(
+        "--manifest-algo",
+        dest="manifest_algorithms",
+        action="append",
+        choices=HASH_BACKENDS.keys(),
+        metavar="ALGO",
+        help="algorithm used for the manifest, can be repeated, computed in the same pass as the fingerprint (default is the fingerprint algorithm)",
+    )
+    parser.add_argument(
+        "--jsonl",
+        action="store_true",
+        help="write manifest as json lines instead of sha256sum format",
+    )
+    parser.add_argument(
+        "--journal",
+        type=Path,
+        metavar="FILE",
+        help="record renames in FILE, to be able to undo them",
+    )
+    parser.add_argument(
+        "--undo",
+        type=Path,
+        metavar="FILE",
+        help="revert renames recorded in the given journal, then exit",
+    )
+    parser.add_argument(
+        "--find-duplicates",
+        action="store_true",
+        help="report files having the same content instead of renaming them",
+    )
+    parser.add_argument(
+        "--link",
+        choices=("hard", "reflink"),
+        help="with --find-duplicates, replace duplicates with hard links or reflinks",
+    )
+    parser.add_argument(
+        "--stats-json",
+        type=Path,
+        metavar="FILE",
+        help="write run statistics (throughput, latency, cache hits...) to FILE",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="do not use cached fingerprints",
+    )
+    parser.add_argument(
+        "--verify-cache",
+        action="store_true",
+        help="compute fingerprints even if cached and report mismatches",
+    )
+    parser.add_argument(
+        "--prune-cache",
+        action="store_true",
+        help="remove deleted or modified files from cache",
+    )
     parser.add_argument(
         "files",
-        nargs=ONE_OR_MORE,
+        nargs=ZERO_OR_MORE,
         type=Path,
         help="files to rename",
     )
     args = parser.parse_args()
 
+    def backend(name: str) -> HashBackend:
+        if args.digest_size:
+            return HASH_BACKENDS[name].with_digest_size(args.digest_size)
+        return HASH_BACKENDS[name]
+
+    if args.benchmark is not None:
+        benchmark(
+            [
+                backend(n) if n == args.algorithm else HASH_BACKENDS[n]
+                for n in HASH_BACKENDS
+            ],
+            args.benchmark,
+            length=args.length,
+        )
+        return
+    if args.undo is not None:
+        return undo(args.undo, dryrun=args.dryrun)
+    if len(args.files) == 0:
+        parser.error("the following arguments are required: files")
+
+    try:
+        selected = [
+            backend(a)
+            for a in dict.fromkeys(
+                [args.algorithm] + (args.manifest_algorithms or [args.algorithm])
+            )
+        ]
+    except ValueError as error:
+        parser.error(str(error))
+    manifest_algorithms = [
+        backend(a).name
+        for a in dict.fromkeys(args.manifest_algorithms or [args.algorithm])
+    ]
+    algorithms = [b.name for b in selected]
+    hfuncs = [b.factory for b in selected]
+    if args.calibrate:
+        args.chunk_size = calibrate(selected[0].factory)
+        print(
+            f"{ICON_HINT} use chunks of {Fore.YELLOW}{args.chunk_size >> 10}K{Fore.RESET} for {algorithms[0]}"
+        )
+    elif args.chunk_size is None:
+        args.chunk_size = max(b.chunk_size for b in selected)
+    cache = FingerprintCache(cache_dir() / "hrenamer.db") if args.cache else None
+    if cache is not None and args.prune_cache:
+        count_pruned = cache.prune()
+        if args.verbose:
+            print(
+                f"{ICON_HINT} {count_pruned} entr{'ies' if count_pruned > 1 else 'y'} removed from cache"
+            )
+
     count_already_named, count_error, count_renamed = 0, 0, 0
+    stats = RunStats(progress=sys.stderr.isatty())
 
-    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
-        jobs = {
-            executor.submit(compute_hash, args.hfunc, f): f
-            for f in visit(args.files, recursive=args.recursive, verbose=args.verbose)
-        }
+    def collect(job, f, st, cached):
+        result, elapsed = job.result()
+        stats.hashed(st.st_size, elapsed)
+        digests = dict(zip(algorithms, result))
+        if cache is not None:
+            for algorithm, digest in digests.items():
+                if cached.get(algorithm) not in (None, digest):
+                    print(
+                        f"{ICON_UNKNOWN} {label(f)} {algorithm} differs from cache: {Fore.RED}{cached[algorithm]}{Fore.RESET} != {digest}"
+                    )
+                cache.put(st, algorithm, digest, f)
+        return f, st, digests
+
+    def fingerprints(scheduler: DeviceScheduler, queue_size: int):
+        """
+        yield files with their fingerprints as soon as they are available,
+        keeping at most queue_size files being hashed per device
+        """
+        jobs, inflight = {}, defaultdict(int)
+        for f, st in visit(
+            args.files,
+            recursive=args.recursive,
+            verbose=args.verbose,
+            by_inode=scheduler.is_rotational,
+        ):
+            cached = (
+                {a: cache.get(st, a) for a in algorithms} if cache is not None else {}
+            )
+            if all(cached.get(a) for a in algorithms) and not args.verify_cache:
+                stats.cached()
+                yield f, st, cached
+                continue
+            jobs[
+                scheduler.submit(
+                    st.st_dev,
+                    timed,
+                    compute_hashes,
+                    hfuncs,
+                    f,
+                    args.chunk_size,
+                    args.mmap,
+                )
+            ] = (f, st, cached)
+            inflight[st.st_dev] += 1
+            stats.queued(len(jobs))
+            while inflight[st.st_dev] >= queue_size:
+                done, _ = wait(jobs, return_when=FIRST_COMPLETED)
+                for job in done:
+                    f, st_done, cached = jobs.pop(job)
+                    inflight[st_done.st_dev] -= 1
+                    yield collect(job, f, st_done, cached)
+                stats.queued(len(jobs))
         for job in as_completed(jobs):
-            source = jobs[job]
-            fingerprint = job.result()
+            stats.queued(stats.queue_depth - 1)
+            yield collect(job, *jobs[job])
+
+    if args.find_duplicates:
+        return duplicates(args, selected[0], cache)
+
+    manifest = None
+    if args.manifest is not None:
+        manifest = Manifest(
+            args.manifest.open("w"), manifest_algorithms, jsonl=args.jsonl
+        )
+
+    # first phase: compute all targets
+    renames = []
+    pool = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+    workers = args.jobs or os.cpu_count() or 1
+    with DeviceScheduler(pool, workers, args.jobs_per_device) as scheduler:
+        for source, st, digests in fingerprints(
+            scheduler, args.queue_size or 4 * (args.jobs_per_device or workers)
+        ):
             newfilename = compute_filename(
-                fingerprint,
+                digests[algorithms[0]],
                 length=args.length,
                 prefix=args.prefix,
                 suffix=args.suffix,
                 extension=source.suffix if args.ext else None,
             )
-
             assert len(newfilename) > 0
-            target = (args.folder or source.parent) / newfilename
-
-            if source == target:
-                count_already_named += 1
-                if args.verbose:
-                    print(f"{ICON_OK} {label(source)} is already renamed")
-            elif target.exists():
-                count_error += 1
+            renames.append(
+                Rename(
+                    source, (args.folder or source.parent) / newfilename, st, digests
+                )
+            )
+
+    stats.clear()
+
+    # resolve conflicts before renaming anything
+    named, conflicts, steps = plan_renames(renames)
+    count_already_named = len(named)
+    if args.verbose:
+        for rename in named:
+            print(f"{ICON_OK} {label(rename.source)} is already renamed")
+    for rename in conflicts:
+        count_error += 1
+        print(
+            f"{ICON_EXISTS} {label(rename.source)} cannot be renamed {label(rename.target)}: {Fore.RED}destination already exists{Fore.RESET}"
+        )
+
+    # second phase: apply renames
+    journal = Journal(args.journal) if args.journal and not args.dryrun else None
+    failed = set()
+    for source, dest, rename in steps:
+        if id(rename) in failed:
+            continue
+        if args.dryrun:
+            if dest == rename.target:
+                count_renamed += 1
                 print(
-                    f"{ICON_EXISTS} {label(source)} cannot be renamed {label(target)}: {Fore.RED}destination already exists{Fore.RESET}"
+                    f"{ICON_DRYRUN} {label(rename.source)} would be renamed {label(rename.target)} {Fore.CYAN}(dryrun){Style.RESET_ALL}"
                 )
-            elif args.dryrun:
+            continue
+        if journal is not None:
+            # written ahead, so a crash cannot leave an unrecorded rename
+            journal.write(source, dest)
+        try:
+            start = perf_counter()
+            try:
+                move(source, dest)
+            except BaseException:
+                if journal is not None:
+                    journal.write(source, dest, aborted=True)
+                raise
+            stats.renamed(perf_counter() - start)
+            rename.location = dest
+            if dest == rename.target:
+                if cache is not None:
+                    cache.relocate(rename.st, rename.target)
                 count_renamed += 1
                 print(
-                    f"{ICON_DRYRUN} {label(source)} would be renamed {label(target)} {Fore.CYAN}(dryrun){Style.RESET_ALL}"
+                    f"{ICON_OK} {label(rename.source)} was renamed {label(rename.target)}"
                 )
-            else:
+        except BaseException as e:
+            failed.add(id(rename))
+            count_error += 1
+            print(
+                f"{ICON_ERROR} {label(rename.source)} cannot be renamed {label(rename.target)}: {Fore.RED}{e}{Fore.RESET}"
+            )
+    # files of a broken cycle left at their temporary name
+    for rename in renames:
+        if rename.location not in (rename.source, rename.target):
+            if journal is not None:
+                journal.write(rename.location, rename.source)
+            try:
                 try:
-                    if not target.parent.exists():
-                        target.parent.mkdir(parents=True)
-                    shutil.move(source, target)
-                    count_renamed += 1
-                    print(f"{ICON_OK} {label(source)} was renamed {label(target)}")
-                except BaseException as e:
-                    count_error += 1
-                    print(
-                        f"{ICON_ERROR} {label(source)} cannot be renamed {label(target)}: {Fore.RED}{e}{Fore.RESET}"
-                    )
+                    move(rename.location, rename.source)
+                except BaseException:
+                    if journal is not None:
+                        journal.write(rename.location, rename.source, aborted=True)
+                    raise
+                print(
+                    f"{ICON_HINT} {label(rename.location)} was restored {label(rename.source)}"
+                )
+                rename.location = rename.source
+            except BaseException as e:
+                print(
+                    f"{ICON_ERROR} {label(rename.location)} cannot be restored {label(rename.source)}: {Fore.RED}{e}{Fore.RESET}"
+                )
+    if journal is not None:
+        journal.close()
+
+    if manifest is not None:
+        for rename in renames:
+            manifest.write(rename.location, rename.st.st_size, rename.digests)
+
+    if cache is not None:
+        cache.close()
+    if manifest is not None:
+        manifest.fp.close()
+    if args.stats_json is not None:
+        with args.stats_json.open("w") as fp:
+            json.dump(stats.to_json(), fp, indent=2)
 
     if count_renamed:
         print(
@@ -226,6 +1331,8 @@ def main():
         print(
             f"    {ICON_OK} {count_already_named} file{plural(count_already_named)} already named",
         )
+    if args.verbose:
+        print(f"    {ICON_HINT} {stats.summary()}")
     if count_error:
         print(
             f"    {ICON_ERROR} {count_error} error{plural(count_error)}",
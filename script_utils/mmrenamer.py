@@ -1,17 +1,31 @@
 #!/usr/bin/python3
 
+import os
 import re
 import shutil
+import sqlite3
+import threading
 from argparse import ONE_OR_MORE, ArgumentParser
+from collections import defaultdict
 from collections.abc import Iterable
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from io import BytesIO
 from json import loads
 from pathlib import Path
-from subprocess import check_output
+from struct import error as StructError
+from struct import unpack, unpack_from
+from subprocess import PIPE, Popen, check_output
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
 from colorama import Fore, Style
 
+try:
+    import numpy
+    from PIL import Image
+except ImportError:
+    numpy = None
+
 ICON_OK = "✅"
 ICON_EXISTS = "🚩"
 ICON_ERROR = "💥"
@@ -35,6 +49,16 @@ EXIF_KEYS_BY_PREFIX = {
 }
 
 
+HEIF_BRANDS = (b"heic", b"heix", b"heim", b"heis", b"hevc", b"mif1", b"msf1", b"avif")
+# ftyp major brands of videos, 3GPP brands are matched on their prefix
+VIDEO_BRANDS = (b"isom", b"iso2", b"mp41", b"mp42", b"avc1", b"M4V ", b"qt  ")
+VIDEO_BRAND_PREFIXES = (b"3gp", b"3g2")
+QUICKTIME_EPOCH = datetime(1904, 1, 1)
+MAX_BOX_SIZE = 16 << 20
+DATE_PREFIX_FORMAT = "%Y-%m-%d_%Hh%Mm%Ss_"
+RENAMED_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}_\d{2}h\d{2}m\d{2}s_\d{3}")
+
+
 def label(item):
     """
     colorize item given its type
@@ -66,6 +90,53 @@ def visit(files: Iterable[Path], recursive: bool = False):
             )
 
 
+def is_rotational(dev: int) -> bool:
+    """
+    tell if a device is a spinning disk, using sysfs
+    """
+    sysfs = Path(f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}")
+    # partitions do not have a queue, use their parent disk
+    for queue in (sysfs / "queue", sysfs / ".." / "queue"):
+        try:
+            return (queue / "rotational").read_text().strip() == "1"
+        except OSError:
+            pass
+    return False
+
+
+class DeviceScheduler:
+    """
+    dispatch jobs to one executor per device, so that spinning disks are
+    read by a single worker while faster devices get all the workers
+    """
+
+    def __init__(self, workers: Optional[int] = None, jobs_per_device: int = 0):
+        self.workers = workers
+        self.jobs_per_device = jobs_per_device
+        self.executors = {}
+        self.rotational = {}
+
+    def is_rotational(self, dev: int) -> bool:
+        if dev not in self.rotational:
+            self.rotational[dev] = is_rotational(dev)
+        return self.rotational[dev]
+
+    def submit(self, dev: int, fn: Callable, *args):
+        if dev not in self.executors:
+            self.executors[dev] = ThreadPoolExecutor(
+                max_workers=self.jobs_per_device
+                or (1 if self.is_rotational(dev) else self.workers)
+            )
+        return self.executors[dev].submit(fn, *args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        for executor in self.executors.values():
+            executor.shutdown()
+
+
 def parse_date(text: str) -> datetime:
     """
     exiftool date are not datetime compatible
@@ -74,37 +145,595 @@ def parse_date(text: str) -> datetime:
     return datetime.fromisoformat(text.replace(":", "-", 2)[0:19])
 
 
-def get_create_date(file: Path):
+class ExifTool:
     """
-    get date prefix
+    long-lived exiftool process reading its arguments from stdin, to avoid
+    paying the perl startup cost for every file
     """
-    if not file.exists():
-        raise IOError(f"Cannot find {file}")
-    payload = check_output(["exiftool", "-G", "-j", str(file)])
+
+    READY = b"{ready}\n"
+
+    def __init__(self):
+        self.process = Popen(
+            ["exiftool", "-stay_open", "True", "-@", "-"], stdin=PIPE, stdout=PIPE
+        )
+
+    def execute(self, *args: str) -> bytes:
+        if any(
+            "\n" in arg or arg.startswith("#") or arg != arg.strip() or not arg
+            for arg in args
+        ):
+            # arguments are read line per line, lines starting with # are
+            # comments, blank lines are ignored and whitespace is stripped
+            return check_output(["exiftool", *args])
+        self.process.stdin.write(
+            b"".join(os.fsencode(arg) + b"\n" for arg in args) + b"-execute\n"
+        )
+        self.process.stdin.flush()
+        output = b""
+        while not output.endswith(self.READY):
+            chunk = self.process.stdout.read1(1 << 16)
+            if not chunk:
+                raise IOError("exiftool process exited unexpectedly")
+            output += chunk
+        return output[: -len(self.READY)]
+
+    def close(self):
+        self.process.stdin.write(b"-stay_open\nFalse\n")
+        self.process.stdin.flush()
+        self.process.wait()
+
+
+class ExifToolPool:
+    """
+    one exiftool process per thread, created on first use
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.instances = []
+
+    def get(self) -> ExifTool:
+        if not hasattr(self.local, "exiftool"):
+            self.local.exiftool = ExifTool()
+            with self.lock:
+                self.instances.append(self.local.exiftool)
+        return self.local.exiftool
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        for exiftool in self.instances:
+            exiftool.close()
+
+
+def read_ifd(data: bytes, offset: int, order: str) -> Tuple[Dict[int, object], int]:
+    """
+    read ascii and integer tags of a TIFF IFD, return them with the next IFD offset
+    """
+    (count,) = unpack_from(order + "H", data, offset)
+    tags = {}
+    for entry in range(offset + 2, offset + 2 + 12 * count, 12):
+        tag, kind, size = unpack_from(order + "HHI", data, entry)
+        if kind == 2:
+            start = (
+                entry + 8 if size <= 4 else unpack_from(order + "I", data, entry + 8)[0]
+            )
+            value = data[start : start + size].split(b"\0", 1)[0]
+            tags[tag] = value.decode("ascii", "replace").strip()
+        elif kind == 3:
+            tags[tag] = unpack_from(order + "H", data, entry + 8)[0]
+        elif kind == 4:
+            tags[tag] = unpack_from(order + "I", data, entry + 8)[0]
+    return tags, unpack_from(order + "I", data, offset + 2 + 12 * count)[0]
+
+
+def parse_tiff(data: bytes) -> Dict[str, Dict[int, object]]:
+    """
+    read IFD0, EXIF IFD and IFD1 (thumbnail) of a TIFF structure
+    """
+    order = {b"II": "<", b"MM": ">"}[data[0:2]]
+    ifd0, next_ifd = read_ifd(data, unpack_from(order + "I", data, 4)[0], order)
+    out = {"ifd0": ifd0, "exif": {}, "ifd1": {}}
+    if 0x8769 in ifd0:
+        out["exif"] = read_ifd(data, ifd0[0x8769], order)[0]
+    if next_ifd:
+        out["ifd1"] = read_ifd(data, next_ifd, order)[0]
+    return out
+
+
+def exif_dates(tiff: bytes) -> Dict[str, str]:
+    """
+    dates from EXIF, named like exiftool does
+    """
+    exif = parse_tiff(tiff)["exif"]
+    out = {}
+    for key, date_tag, subsec_tag in (
+        ("DateTimeOriginal", 0x9003, 0x9291),
+        ("CreateDate", 0x9004, 0x9292),
+    ):
+        if exif.get(date_tag):
+            out[f"EXIF:{key}"] = exif[date_tag]
+            if exif.get(subsec_tag):
+                out[f"Composite:SubSec{key}"] = f"{exif[date_tag]}.{exif[subsec_tag]}"
+    return out
+
+
+def read_jpeg_exif(fp) -> Optional[bytes]:
+    """
+    find the APP1 EXIF segment of a JPEG file, reading only segments headers
+    """
+    fp.seek(2)
+    while True:
+        header = fp.read(4)
+        if len(header) < 4 or header[0] != 0xFF or header[1] in (0xDA, 0xD9):
+            return None
+        (length,) = unpack(">H", header[2:])
+        if header[1] == 0xE1:
+            payload = fp.read(length - 2)
+            if payload.startswith(b"Exif\0\0"):
+                return payload[6:]
+        else:
+            fp.seek(length - 2, os.SEEK_CUR)
+
+
+def file_boxes(fp, end: int) -> Iterator[Tuple[bytes, int, int]]:
+    """
+    yield type, payload offset and payload size of ISO-BMFF top level boxes,
+    seeking from header to header without reading payloads
+    """
+    offset = 0
+    while offset + 8 <= end:
+        fp.seek(offset)
+        size, kind = unpack(">I4s", fp.read(8))
+        header_size = 8
+        if size == 1:
+            (size,) = unpack(">Q", fp.read(8))
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+        yield kind, offset + header_size, size - header_size
+        offset += size
+
+
+def boxes(data: bytes, offset: int = 0) -> Iterator[Tuple[bytes, bytes]]:
+    """
+    yield type and payload of ISO-BMFF boxes contained in data
+    """
+    while offset + 8 <= len(data):
+        size, kind = unpack_from(">I4s", data, offset)
+        header_size = 8
+        if size == 1:
+            (size,) = unpack_from(">Q", data, offset + 8)
+            header_size = 16
+        elif size == 0:
+            size = len(data) - offset
+        if size < header_size:
+            return
+        yield kind, data[offset + header_size : offset + size]
+        offset += size
+
+
+def quicktime_date(payload: bytes) -> str:
+    """
+    creation date of a mvhd or mdhd box, as exiftool prints it
+    """
+    if payload[0] == 1:
+        (seconds,) = unpack_from(">Q", payload, 4)
+    else:
+        (seconds,) = unpack_from(">I", payload, 4)
+    if seconds == 0:
+        return "0000:00:00 00:00:00"
+    return (QUICKTIME_EPOCH + timedelta(seconds=seconds)).strftime("%Y:%m:%d %H:%M:%S")
+
+
+def apple_creation_date(meta: bytes) -> Optional[str]:
+    """
+    find com.apple.quicktime.creationdate in a QuickTime meta box
+    """
+    if meta[4:8] != b"hdlr":
+        # MP4 meta is a full box, with version and flags
+        meta = meta[4:]
+    keys, ilst = [], b""
+    for kind, payload in boxes(meta):
+        if kind == b"keys":
+            for key_kind, key in boxes(payload, 8):
+                keys.append(key)
+        elif kind == b"ilst":
+            ilst = payload
+    for kind, payload in boxes(ilst):
+        index = int.from_bytes(kind, "big")
+        if (
+            0 < index <= len(keys)
+            and keys[index - 1] == b"com.apple.quicktime.creationdate"
+        ):
+            for data_kind, data in boxes(payload):
+                if data_kind == b"data":
+                    value = data[8:].decode()
+                    return f"{value[0:4]}:{value[5:7]}:{value[8:10]} {value[11:]}"
+    return None
+
+
+def video_dates(moov: bytes) -> Dict[str, str]:
+    """
+    dates from a moov box, named like exiftool does
+    """
+    out = {}
+    for kind, payload in boxes(moov):
+        if kind == b"mvhd":
+            out["QuickTime:CreateDate"] = quicktime_date(payload)
+        elif kind == b"meta":
+            creation_date = apple_creation_date(payload)
+            if creation_date:
+                out["QuickTime:CreationDate"] = creation_date
+        elif kind == b"trak" and "QuickTime:MediaCreateDate" not in out:
+            for mdia_kind, mdia in boxes(payload):
+                if mdia_kind == b"mdia":
+                    for mdhd_kind, mdhd in boxes(mdia):
+                        if mdhd_kind == b"mdhd":
+                            out["QuickTime:MediaCreateDate"] = quicktime_date(mdhd)
+    return out
+
+
+def heif_exif_location(meta: bytes) -> Optional[Tuple[int, int]]:
+    """
+    find offset and length of the EXIF item of a HEIF file
+    """
+    exif_id, locations = None, {}
+    for kind, payload in boxes(meta, 4):
+        if kind == b"iinf":
+            for infe_kind, infe in boxes(payload, 6 if payload[0] == 0 else 8):
+                if infe_kind == b"infe" and infe[0] >= 2:
+                    id_size = 2 if infe[0] == 2 else 4
+                    if infe[6 + id_size : 10 + id_size] == b"Exif":
+                        exif_id = int.from_bytes(infe[4 : 4 + id_size], "big")
+        elif kind == b"iloc":
+            locations = parse_iloc(payload)
+    return locations.get(exif_id)
+
+
+def parse_iloc(payload: bytes) -> Dict[int, Tuple[int, int]]:
+    """
+    offset and length of the first extent of every item stored in the file
+    """
+    version, position = payload[0], 4
+
+    def read(size: int) -> int:
+        nonlocal position
+        position += size
+        return int.from_bytes(payload[position - size : position], "big")
+
+    offset_size, length_size = payload[4] >> 4, payload[4] & 15
+    base_offset_size = payload[5] >> 4
+    index_size = payload[5] & 15 if version in (1, 2) else 0
+    position = 6
+    out = {}
+    for _ in range(read(2 if version < 2 else 4)):
+        item_id = read(2 if version < 2 else 4)
+        method = read(2) & 15 if version in (1, 2) else 0
+        read(2)
+        base_offset = read(base_offset_size)
+        extents = [
+            (read(index_size), read(offset_size), read(length_size))
+            for _ in range(read(2))
+        ]
+        if method == 0 and extents:
+            out[item_id] = (base_offset + extents[0][1], extents[0][2])
+    return out
+
+
+def read_native_metadata(file: Path) -> Optional[Dict[str, str]]:
+    """
+    read dates of JPEG, HEIC, MP4 and MOV files without exiftool, only
+    reading headers, return None for unsupported files
+    """
+    try:
+        with file.open("rb") as fp:
+            magic = fp.read(12)
+            if magic.startswith(b"\xff\xd8"):
+                tiff = read_jpeg_exif(fp)
+                return {
+                    "File:MIMEType": "image/jpeg",
+                    **(exif_dates(tiff) if tiff else {}),
+                }
+            if magic[4:8] != b"ftyp":
+                return None
+            brand, found = None, {}
+            for kind, offset, size in file_boxes(fp, os.fstat(fp.fileno()).st_size):
+                if kind == b"ftyp":
+                    fp.seek(offset)
+                    brand = fp.read(4)
+                elif kind in (b"moov", b"meta") and size <= MAX_BOX_SIZE:
+                    fp.seek(offset)
+                    found[kind] = fp.read(size)
+                    if kind == b"moov" or brand in HEIF_BRANDS:
+                        break
+            if brand in HEIF_BRANDS and b"meta" in found:
+                out = {"File:MIMEType": "image/heic"}
+                location = heif_exif_location(found[b"meta"])
+                if location is not None:
+                    fp.seek(location[0])
+                    exif = fp.read(location[1])
+                    out.update(exif_dates(exif[4 + unpack(">I", exif[:4])[0] :]))
+                return out
+            if b"moov" in found and (
+                brand in VIDEO_BRANDS or brand[:3] in VIDEO_BRAND_PREFIXES
+            ):
+                return {
+                    "File:MIMEType": (
+                        "video/quicktime" if brand == b"qt  " else "video/mp4"
+                    ),
+                    **video_dates(found[b"moov"]),
+                }
+    except (StructError, KeyError, IndexError, ValueError):
+        pass
+    return None
+
+
+def read_exiftool_metadata(file: Path, exiftools: Optional[ExifToolPool] = None):
+    """
+    read metadata with exiftool
+    """
+    if exiftools is not None:
+        payload = exiftools.get().execute("-G", "-j", str(file))
+    else:
+        payload = check_output(["exiftool", "-G", "-j", str(file)])
+    if not payload.strip():
+        raise ValueError(f"Cannot read metadata of {file}")
     payload = loads(payload)
     assert isinstance(payload, list)
     assert len(payload) == 1
-    exif = payload[0]
+    return payload[0]
+
+
+def get_media_info(
+    file: Path, exiftools: Optional[ExifToolPool] = None
+) -> Tuple[datetime, str]:
+    """
+    get creation date and mime type
+    """
+    if not file.exists():
+        raise IOError(f"Cannot find {file}")
+    exif = read_native_metadata(file)
+    if exif is None or not any(
+        key in exif for keys in EXIF_KEYS_BY_PREFIX.values() for key in keys
+    ):
+        # unsupported format or dates stored elsewhere
+        exif = read_exiftool_metadata(file, exiftools)
 
     filetype = exif["File:MIMEType"]
     for prefix, keys in EXIF_KEYS_BY_PREFIX.items():
         if filetype.startswith(prefix):
             for key in keys:
                 if key in exif:
-                    return parse_date(exif[key])
+                    return parse_date(exif[key]), filetype
             raise ValueError(f"Cannot find date for {file}")
     raise ValueError(f"Unsupported file type {filetype} for {file}")
 
 
-def get_next_name(folder: Path, prefix: str, suffix: str) -> Path:
+def get_create_date(file: Path, exiftools: Optional[ExifToolPool] = None):
+    """
+    get date prefix
+    """
+    return get_media_info(file, exiftools)[0]
+
+
+def cache_dir() -> Path:
+    """
+    folder where persistent data is cached, following XDG specification
+    """
+    return Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache") / "script-utils"
+
+
+class MetadataCache:
+    """
+    persistent cache of creation dates and mime types, keyed by file identity:
+    as long as the device, inode, size and modification time are unchanged,
+    metadata are not extracted again
+    """
+
+    COMMIT_INTERVAL = 1000
+
+    def __init__(self, dbfile: Path):
+        dbfile.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(dbfile))
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            "dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, "
+            "date TEXT, mimetype TEXT, path TEXT, "
+            "PRIMARY KEY (dev, ino, size, mtime_ns))"
+        )
+        self.pending = 0
+
+    @staticmethod
+    def identity(st: os.stat_result):
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def get(self, st: os.stat_result) -> Optional[Tuple[datetime, str]]:
+        row = self.db.execute(
+            "SELECT date, mimetype FROM metadata "
+            "WHERE dev=? AND ino=? AND size=? AND mtime_ns=?",
+            self.identity(st),
+        ).fetchone()
+        return (datetime.fromisoformat(row[0]), row[1]) if row else None
+
+    def put(self, st: os.stat_result, date: datetime, mimetype: str, file: Path):
+        self.db.execute(
+            "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (*self.identity(st), date.isoformat(), mimetype, str(file)),
+        )
+        self.pending += 1
+        if self.pending >= self.COMMIT_INTERVAL:
+            self.commit()
+
+    def relocate(self, st: os.stat_result, file: Path):
+        """
+        update the path of a cached file, after it was renamed
+        """
+        self.db.execute(
+            "UPDATE metadata SET path=? WHERE dev=? AND ino=? AND size=? AND mtime_ns=?",
+            (str(file), *self.identity(st)),
+        )
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class NameIndex:
+    """
+    names of the files of the target folders, each folder is listed once and
+    then updated as files are renamed, to give the next free filename without
+    probing the filesystem
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.folders = {}
+        # lowest index which may be free, by folder, prefix and suffix
+        self.hints = {}
+
+    def names(self, folder: Path) -> set:
+        folder = folder.resolve()
+        if folder not in self.folders:
+            try:
+                with os.scandir(folder) as entries:
+                    self.folders[folder] = {entry.name for entry in entries}
+            except FileNotFoundError:
+                # folder to be created
+                self.folders[folder] = set()
+        return self.folders[folder]
+
+    def reserve(self, folder: Path, prefix: str, suffix: str) -> Path:
+        """
+        find filename which wouldn't overwrite anything in the given folder
+        """
+        folder, suffix = folder.resolve(), suffix.lower()
+        with self.lock:
+            names = self.names(folder)
+            for index in range(self.hints.get((folder, prefix, suffix), 1), 999):
+                name = f"{prefix}{index:03}{suffix}"
+                if name not in names:
+                    names.add(name)
+                    self.hints[(folder, prefix, suffix)] = index + 1
+                    return folder / name
+        raise ValueError(f"Cannot find a suitable filename in {folder}")
+
+    def release(self, file: Path):
+        """
+        forget a filename, after the file was renamed or if a reserved name
+        was not used
+        """
+        with self.lock:
+            self.names(file.parent).discard(file.name)
+            match = re.fullmatch(r"(.*_)(\d{3})(\..*)?", file.name)
+            if match is not None:
+                key = (file.parent.resolve(), match.group(1), match.group(3) or "")
+                if key in self.hints:
+                    self.hints[key] = min(self.hints[key], int(match.group(2)))
+
+
+def read_exif_thumbnail(file: Path) -> Optional[bytes]:
+    """
+    extract the JPEG thumbnail embedded in the EXIF of a JPEG file
+    """
+    try:
+        with file.open("rb") as fp:
+            if fp.read(2) != b"\xff\xd8":
+                return None
+            tiff = read_jpeg_exif(fp)
+        if tiff is not None:
+            ifd1 = parse_tiff(tiff)["ifd1"]
+            if 0x0201 in ifd1 and 0x0202 in ifd1:
+                return tiff[ifd1[0x0201] : ifd1[0x0201] + ifd1[0x0202]]
+    except (StructError, KeyError, IndexError):
+        pass
+    return None
+
+
+def perceptual_hash(file: Path) -> Optional[int]:
     """
-    find filename which wouldn't overwrite anything in the given folder
+    compute the 64 bits difference hash (dHash) of an image, using its EXIF
+    thumbnail when there is one
     """
-    for index in range(1, 999):
-        dest = folder / f"{prefix}{index:03}{suffix.lower()}"
-        if not dest.exists():
-            return dest
-    raise ValueError(f"Cannot find a suitable filename in {folder}")
+    thumbnail = read_exif_thumbnail(file)
+    try:
+        with Image.open(BytesIO(thumbnail) if thumbnail else file) as image:
+            # let the JPEG decoder downscale the image
+            image.draft("L", (64, 64))
+            pixels = numpy.asarray(image.convert("L").resize((9, 8)), dtype=numpy.int16)
+    except OSError:
+        return None
+    bits = numpy.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+def find_similar(
+    images: List[Tuple[Path, datetime, int]], distance: int, window: int
+) -> List[List[Path]]:
+    """
+    cluster images whose perceptual hashes differ by at most distance bits,
+    only comparing images taken in the same or the next time window
+    """
+    buckets = defaultdict(list)
+    for index, (_, date, _) in enumerate(images):
+        buckets[int(date.timestamp()) // window].append(index)
+    hashes = numpy.array([h for _, _, h in images], dtype=numpy.uint64)
+    parent = list(range(len(images)))
+
+    def root(index: int) -> int:
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    for bucket, left in buckets.items():
+        right = numpy.array(left + buckets.get(bucket + 1, []))
+        left = numpy.array(left)
+        xor = hashes[left][:, None] ^ hashes[right][None, :]
+        bits = numpy.unpackbits(xor.view(numpy.uint8).reshape(*xor.shape, 8), axis=-1)
+        for i, j in zip(*numpy.nonzero(bits.sum(axis=-1) <= distance)):
+            if left[i] != right[j]:
+                parent[root(left[i])] = root(right[j])
+
+    clusters = defaultdict(list)
+    for index, (file, _, _) in enumerate(images):
+        clusters[root(index)].append(file)
+    return [sorted(c) for c in clusters.values() if len(c) > 1]
+
+
+def copy_move(source: Path, target: Path):
+    """
+    move a file to another device: copy it to a temporary file, flush it to
+    disk and rename it, and only then remove the source
+    """
+    tmp = target.with_name(f".{target.name}.mmrenamer")
+    try:
+        shutil.copy2(source, tmp)
+        fd = os.open(tmp, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(tmp, target)
+    except BaseException:
+        if tmp.exists():
+            tmp.unlink()
+        raise
+    fd = os.open(target.parent, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    source.unlink()
 
 
 def main():
@@ -124,6 +753,54 @@ def main():
         action="store_true",
         help="visit folder content",
     )
+    parser.add_argument(
+        "--jobs-per-device",
+        type=int,
+        metavar="N",
+        default=0,
+        help="parallel jobs for every device, by default spinning disks use a single job",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=Path,
+        metavar="DIR",
+        help="move files in DIR, in folders given by --layout",
+    )
+    parser.add_argument(
+        "--layout",
+        default="{Y}/{m}",
+        metavar="LAYOUT",
+        help="folders layout in output folder using {Y}, {m}, {d}, {H}, {M} and {S} date fields, default is {Y}/{m}",
+    )
+    parser.add_argument(
+        "--copy-jobs",
+        type=int,
+        metavar="N",
+        default=4,
+        help="parallel copies when moving files to another device, default is 4",
+    )
+    parser.add_argument(
+        "--similar",
+        nargs="?",
+        type=int,
+        const=10,
+        metavar="MAXDIST",
+        help="report similar images instead of renaming, images are similar if their perceptual hashes differ by at most MAXDIST bits (default is 10), requires numpy and Pillow",
+    )
+    parser.add_argument(
+        "--similar-window",
+        type=int,
+        default=60,
+        metavar="SECONDS",
+        help="only compare images taken less than SECONDS apart, default is 60",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="do not use cached metadata",
+    )
     parser.add_argument(
         "files",
         nargs=ONE_OR_MORE,
@@ -131,31 +808,98 @@ def main():
         help="files to rename",
     )
     args = parser.parse_args()
+    if args.similar is not None and numpy is None:
+        parser.error("--similar requires numpy and Pillow")
     count_already_named, count_error, count_renamed = 0, 0, 0
-    with ThreadPoolExecutor() as executor:
-        jobs = {
-            executor.submit(lambda f: get_create_date(f), f): f
-            for f in visit(args.files, recursive=args.recursive)
-        }
+    dated = []
+    cache = MetadataCache(cache_dir() / "mmrenamer.db") if args.cache else None
+    names = NameIndex()
+    created, devices, copies = set(), {}, {}
+
+    # folders are compared and indexed as resolved paths
+    output = args.output.resolve() if args.output is not None else None
+
+    def target_folder(source: Path, create_date: datetime) -> Path:
+        if output is None:
+            return source.parent.resolve()
+        return output / args.layout.format(
+            **{field: create_date.strftime(f"%{field}") for field in "YmdHMS"}
+        )
+
+    with ExifToolPool() as exiftools, DeviceScheduler(
+        jobs_per_device=args.jobs_per_device
+    ) as scheduler, ThreadPoolExecutor(max_workers=args.copy_jobs) as copier:
+        files = [(f, f.stat()) for f in visit(args.files, recursive=args.recursive)]
+        # on spinning disks, inode order is closer to the physical order
+        files.sort(
+            key=lambda x: (
+                x[1].st_dev,
+                x[1].st_ino if scheduler.is_rotational(x[1].st_dev) else 0,
+            )
+        )
+        jobs = {}
+        for f, st in files:
+            info = cache.get(st) if cache is not None else None
+            if info is None:
+                jobs[scheduler.submit(st.st_dev, get_media_info, f, exiftools)] = (
+                    f,
+                    st,
+                    False,
+                )
+            elif (
+                args.similar is None
+                and RENAMED_PATTERN.match(f.name)
+                and f.name.startswith(info[0].strftime(DATE_PREFIX_FORMAT))
+                and target_folder(f, info[0]) == f.parent.resolve()
+            ):
+                # skip files already renamed according to the cache
+                count_already_named += 1
+                print(f"{ICON_EXISTS} {label(f)} is already renamed")
+            else:
+                job = Future()
+                job.set_result(info)
+                jobs[job] = f, st, True
         for job in as_completed(jobs):
-            source = jobs[job]
+            source, st, cached = jobs[job]
             try:
-                create_date = job.result()
-                prefix = create_date.strftime("%Y-%m-%d_%Hh%Mm%Ss_")
-                if source.name.startswith(prefix):
+                create_date, mimetype = job.result()
+                if cache is not None and not cached:
+                    cache.put(st, create_date, mimetype, source)
+                if args.similar is not None:
+                    if mimetype.startswith("image/"):
+                        dated.append((source, create_date))
+                    continue
+                prefix = create_date.strftime(DATE_PREFIX_FORMAT)
+                folder = target_folder(source, create_date)
+                if source.name.startswith(prefix) and folder == source.parent.resolve():
                     count_already_named += 1
                     print(f"{ICON_EXISTS} {label(source)} is already renamed")
-                else:
-                    target = get_next_name(source.parent, prefix, source.suffix)
-                    if args.dryrun:
-                        count_renamed += 1
-                        print(
-                            f"{ICON_DRYRUN} {label(source)} would be renamed {label(target)} {Fore.CYAN}(dryrun){Style.RESET_ALL}"
-                        )
-                    else:
-                        shutil.move(source, target)
-                        count_renamed += 1
-                        print(f"{ICON_OK} {label(source)} was renamed {label(target)}")
+                    continue
+                if not args.dryrun and folder not in created:
+                    folder.mkdir(parents=True, exist_ok=True)
+                    created.add(folder)
+                target = names.reserve(folder, prefix, source.suffix)
+                if args.dryrun:
+                    count_renamed += 1
+                    print(
+                        f"{ICON_DRYRUN} {label(source)} would be renamed {label(target)} {Fore.CYAN}(dryrun){Style.RESET_ALL}"
+                    )
+                    continue
+                if folder not in devices:
+                    devices[folder] = os.stat(folder).st_dev
+                if devices[folder] != st.st_dev:
+                    copies[copier.submit(copy_move, source, target)] = source, target
+                    continue
+                try:
+                    os.rename(source, target)
+                except BaseException:
+                    names.release(target)
+                    raise
+                names.release(source)
+                if cache is not None:
+                    cache.relocate(st, target)
+                count_renamed += 1
+                print(f"{ICON_OK} {label(source)} was renamed {label(target)}")
             except KeyboardInterrupt:
                 exit(1)
             except BaseException as error:  # pylint: disable=broad-except
@@ -163,6 +907,40 @@ def main():
                 print(
                     f"{ICON_ERROR} cannot be renamed {label(source)}: {Fore.RED}{error}{Fore.RESET}"
                 )
+        for job in as_completed(copies):
+            source, target = copies[job]
+            try:
+                job.result()
+                names.release(source)
+                count_renamed += 1
+                print(f"{ICON_OK} {label(source)} was moved {label(target)}")
+            except KeyboardInterrupt:
+                exit(1)
+            except BaseException as error:  # pylint: disable=broad-except
+                names.release(target)
+                count_error += 1
+                print(
+                    f"{ICON_ERROR} cannot be moved {label(source)}: {Fore.RED}{error}{Fore.RESET}"
+                )
+        if args.similar is not None:
+            images = []
+            jobs = {copier.submit(perceptual_hash, f): (f, d) for f, d in dated}
+            for job in as_completed(jobs):
+                if job.result() is not None:
+                    images.append((*jobs[job], job.result()))
+    if cache is not None:
+        cache.close()
+
+    if args.similar is not None:
+        clusters = find_similar(images, args.similar, args.similar_window)
+        for reference, *others in clusters:
+            for other in others:
+                print(f"{ICON_EXISTS} {label(other)} is similar to {label(reference)}")
+        count_similar = sum(len(c) - 1 for c in clusters)
+        print(
+            f"    {ICON_EXISTS} {count_similar} similar image(s) in {len(clusters)} group(s)",
+        )
+        return
 
     if count_renamed:
         print(